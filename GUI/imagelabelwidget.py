@@ -1,9 +1,7 @@
 from PyQt5 import QtWidgets
-from PyQt5.QtGui import QPixmap, QColor, QPainter
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtGui import QPixmap, QImage, QPainter
 import data.tools as imf
 import numpy as np
-import qimage2ndarray
 from data.data_manager import Datamanager
 from data.image_label import ImageLabel
 
@@ -12,44 +10,50 @@ Specialised QLabel to handle layered information.
 data  -> the data layer of the stack. The "real" image with intensities from an DICOM file
 label -> layer which represents the classified/seeded areas of the image.
 
-pixmap -> Representation of content. (as a bitmap). If no data/label _pixmap specified, the combined map is meant. 
-data and label layers are updated independently.
+pixmap -> Representation of content. (as a bitmap). Data and label layer are fused into one RGBA buffer and
+shown as pixmap_full. data and label layers are updated independently.
 passing of HU window necessary to provide accurate representation.
 '''
 
 
 class ImageLabelWidget(QtWidgets.QLabel):
 
-	def scale_pixmap(self, pixmap: QPixmap) -> QPixmap:
+	def scale_pixmap(self, rgba: np.ndarray) -> QPixmap:
+		# Nearest neighbour scaling of an RGBA buffer to the widget size. The index maps are shared with
+		# render_rect, so partial repaints hit exactly the pixels of a full one
+		rows, cols = self.__scale_maps(rgba.shape[:2])
+		scaled = rgba.view(np.uint32)[:, :, 0].take(rows, axis=0).take(cols, axis=1)
+		return self.__to_pixmap(scaled)
+
+	def __scale_maps(self, shape: tuple) -> tuple:
 		target_geom = self.frameGeometry()
-		return pixmap.scaled(QSize(target_geom.width(), target_geom.height()))
-
-	def labelmap_to_pixmap(self, label_array: np.ndarray, background_pix: QPixmap = None,
-	                       label_list=[1, 2, 3]) -> QPixmap:
-		'''
-		Drawing the defined colors of a label on an (existing) Pixmap. labels get looped and a mask for each created.
-		That mask is used to paint only it's respective areas.
-		:param label_array: w x h numpy array with label Id's on respective pixels
-		:param background_pix:  Area where labels should get painted on. Will be created blank if none provided
-		:param label_list: Selection of which labels to use.
-		:return: QPixmap with background and labels painted on-top
-		'''
-		if background_pix is None:
-			background = QPixmap(label_array.shape[0], label_array.shape[1])
-			background.fill(Qt.transparent)
-		else:
-			background = background_pix.copy()
-		if self.dataman is not None:
-			self.dataman.export_pixmap(background, "background-" + self.name)
-		t_painter = QPainter(background)
-		pix_label = QPixmap.fromImage(qimage2ndarray.gray2qimage(label_array))
-		mask_none = pix_label.createMaskFromColor(QColor(0, 0, 0), Qt.MaskOutColor)
-		for label_id in label_list:
-			mask = pix_label.createMaskFromColor(QColor(label_id, label_id, label_id), Qt.MaskOutColor)
-			t_painter.setPen(ImageLabel.LABEL_COLORS.get(str(label_id)))
-			t_painter.drawPixmap(background.rect(), mask, mask.rect())
-		t_painter.end()
-		return background
+		key = (shape, target_geom.width(), target_geom.height())
+		if key != self.scale_key:
+			self.scale_maps = (imf.nearest_index(shape[0], max(target_geom.height(), 1)),
+			                   imf.nearest_index(shape[1], max(target_geom.width(), 1)))
+			self.scale_key = key
+		return self.scale_maps
+
+	@staticmethod
+	def __to_pixmap(pixels: np.ndarray) -> QPixmap:
+		# (H, W) uint32 or (H, W, 4) uint8 RGBA pixels. QImage only wraps the buffer, the pixmap gets its own
+		# (opaque, native format) copy, so the buffer can be reused afterwards
+		image = QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], QImage.Format_RGBX8888)
+		return QPixmap.fromImage(image)
+
+	def __render_rgba(self, label_array: np.ndarray = None, label_list=None) -> np.ndarray:
+		if label_array is None:
+			label_array = self.array_label
+		if label_array is not None and self.array_window is not None and label_array.shape != self.array_window.shape:
+			label_array = None  # Labels of the previous image, the new ones follow with update_labelmap
+		if label_list is not None:
+			self.label_list = list(label_list)
+		lut_key = (tuple(self.label_list), self.alpha)
+		if lut_key != self.lut_key:
+			self.lut = imf.overlay_lut(ImageLabel.LABEL_COLORS, self.label_list, self.alpha)
+			self.lut_key = lut_key
+		self.array_rgba = imf.render_overlay(label_array, self.lut, self.array_window, out=self.array_rgba)
+		return self.array_rgba
 
 	def update_image(self, array: np.ndarray):
 		self.array_data = array
@@ -57,7 +61,6 @@ class ImageLabelWidget(QtWidgets.QLabel):
 
 	def update_full(self):
 		self.update_window(ww=self.last_ww, wc=self.last_wc, force=True)
-		self.apply_pixmap()
 
 	def apply_pixmap(self, pixmap=None):
 		# Set existing/passed pixmap as the own QLabel.QPixmap for visualisation
@@ -69,67 +72,80 @@ class ImageLabelWidget(QtWidgets.QLabel):
 			self.setPixmap(pixmap)
 		self.update()
 
-	def fuse_pixmap(self, pix_data: QPixmap = None, pix_label: QPixmap = None, alpha: float = 1.0) -> QPixmap:
-		# Combine data and label pixmap to a fused pixmap for display. If no specific map is passed, last
-		# map are searched to use. Alpha blending (0.0-1.0) for label_pixmap strength
-		if pix_data is None:
-			pix_data = self.pixmap_data
-		if pix_label is None:
-			pix_label = self.pixmap_label
-		if pix_data is None and pix_label is None:
-			raise Exception("No data to fuse")
-		if pix_data is None and type(pix_label) == QPixmap:
-			pix_data = QPixmap(pix_label.width(), pix_label.height())
-			pix_data.fill(QColor(255, 255, 255))
-		if pix_label is None:
-			print("Label none")
-			return pix_data
-		target: QPixmap = pix_data.copy()
-		label = pix_label.copy()
-		mask_none = pix_label.createMaskFromColor(QColor(0, 0, 0), Qt.MaskInColor)
-		label.setMask(mask_none)
-		paint = QPainter(target)
-		paint.setOpacity(alpha)
-		paint.drawPixmap(0, 0, label)
-		paint.end()
-		return target
-
-	def update_labelmap(self, labels: np.ndarray, label_list=[1, 2, 3]):
+	def render(self):
+		# Fuse data and label layer, scale to the widget and show it
+		if self.array_label is None and self.array_window is None:
+			return
+		self.pixmap_full = self.scale_pixmap(self.__render_rgba())
+		self.apply_pixmap(self.pixmap_full)
+
+	def show_rgba(self, rgba: np.ndarray):
+		# Show a display-ready (H, W, 4) RGBA buffer, e.g. of data.display_cache. The own layers stay untouched
+		self.pixmap_full = self.scale_pixmap(rgba)
+		self.apply_pixmap(self.pixmap_full)
+
+	def render_rect(self, rect: tuple) -> bool:
+		# Re-render only rect (x, y, width, height in image pixels) into the cached RGBA buffer and copy the scaled
+		# region onto the shown pixmap. Cost scales with the rectangle. False if the cache does not fit the layers
+		if self.pixmap_full is None or self.array_rgba is None or self.array_label is None or \
+			self.array_rgba.shape[:2] != self.array_label.shape or \
+			self.lut_key != (tuple(self.label_list), self.alpha):
+			return False
+		if self.array_window is not None and self.array_window.shape != self.array_label.shape:
+			return False
+		rows, cols = self.__scale_maps(self.array_label.shape)
+		if (len(rows), len(cols)) != (self.pixmap_full.height(), self.pixmap_full.width()):
+			return False  # Widget was resized
+		h_img, w_img = self.array_label.shape
+		x0, y0 = max(rect[0], 0), max(rect[1], 0)
+		x1, y1 = min(rect[0] + rect[2], w_img), min(rect[1] + rect[3], h_img)
+		if x1 <= x0 or y1 <= y0:
+			return True
+		window = self.array_window[y0:y1, x0:x1] if self.array_window is not None else None
+		self.array_rgba[y0:y1, x0:x1] = imf.render_overlay(self.array_label[y0:y1, x0:x1], self.lut, window)
+		# Target pixels whose source lies in the rectangle, the index maps are sorted
+		ty0, ty1 = np.searchsorted(rows, (y0, y1))
+		tx0, tx1 = np.searchsorted(cols, (x0, x1))
+		if ty1 > ty0 and tx1 > tx0:
+			scaled = self.array_rgba.view(np.uint32)[:, :, 0].take(rows[ty0:ty1], axis=0).take(cols[tx0:tx1], axis=1)
+			painter = QPainter(self.pixmap_full)
+			painter.drawPixmap(int(tx0), int(ty0), self.__to_pixmap(scaled))
+			painter.end()
+		self.apply_pixmap(self.pixmap_full)
+		return True
+
+	def update_labelmap(self, labels: np.ndarray, label_list=[1, 2, 3], rect: tuple = None):
 		# Pass new label data and generate new pixmaps based on that data.
+		# rect: only this rectangle (x, y, width, height) of the shown labels changed, e.g. by ImageLabel.paint
+		if rect is not None and labels is self.array_label and list(label_list) == self.label_list and \
+			self.render_rect(rect):
+			return
 		self.array_label = labels
-		pixmap_label_raw = self.labelmap_to_pixmap(label_array=self.array_label, label_list=label_list)
-		self.pixmap_label = self.scale_pixmap(pixmap=pixmap_label_raw)
-		self.pixmap_full = self.fuse_pixmap(None, self.pixmap_label, alpha=self.alpha)
-		self.apply_pixmap(self.pixmap_full)
-		if self.dataman is not None:  # Debug export of data and pixmap
+		self.label_list = list(label_list)
+		self.render()
+		if self.dataman is not None and self.dataman.debug_export:  # Debug export of data and pixmap
 			self.dataman.export_np(labels, "numpy-label {} {}".format(str(label_list), self.name))
-			self.dataman.export_pixmap(pixmap_label_raw, "label to pix raw {} {}".format(str(label_list), self.name))
+			self.dataman.export_pixmap(self.__to_pixmap(self.array_rgba), "label to pix raw {} {}".format(str(label_list), self.name))
 			self.dataman.export_pixmap(self.pixmap_full, "pix-full {} {}".format(str(label_list), self.name))
-			self.dataman.export_pixmap(self.pixmap_label, "pix-label {} {}".format(str(label_list), self.name))
-
-	def set_pixmap_data(self, pix_data: QPixmap):
-		self.pixmap_data = self.scale_pixmap(pixmap=pix_data)
-		self.pixmap_full = self.fuse_pixmap(None, None, self.alpha)
-		self.apply_pixmap()
 
 	def update_pixmap(self, array: np.ndarray):
-		pixmap_raw = QPixmap.fromImage(qimage2ndarray.gray2qimage(array))
-		self.pixmap_data = self.scale_pixmap(pixmap=pixmap_raw)
-		self.pixmap_full = self.fuse_pixmap(self.pixmap_data, self.pixmap_label, alpha=self.alpha)
-		self.apply_pixmap(self.pixmap_full)
+		# New windowed uint8 data layer
+		self.array_window = array
+		self.render()
 
 	def update_window(self, ww, wc, force=False):
 		# Update data layer if HU changed or forced
 		if ww != self.last_ww or wc != self.last_wc or force is True:
-			hu_array = imf.arr_hu_to_arr(self.array_data, ww=ww, wc=wc)
+			out = self.array_window if self.array_window is not None and \
+				self.array_window.shape == self.array_data.shape else None  # Reuse the buffer between slices
+			hu_array = imf.arr_hu_to_arr(self.array_data, ww=ww, wc=wc, dtype=np.uint8, out=out)
 			self.update_pixmap(hu_array)
 			self.last_ww = ww
 			self.last_wc = wc
 
 	def update_transparency(self, alpha_value: float):
 		self.alpha = alpha_value
-		self.pixmap_full = self.fuse_pixmap(None, None, alpha_value)
-		self.apply_pixmap()
+		self.render()
 
 	def setDataman(self, dataman, name="default"):
 		# Set data_manger for potential debug export
@@ -145,8 +161,13 @@ class ImageLabelWidget(QtWidgets.QLabel):
 		self.last_wc = 0
 		self.array_data = None
 		self.array_label = None
-		self.pixmap_data: QPixmap = None
-		self.pixmap_label: QPixmap = None
+		self.array_window: np.ndarray = None  # Windowed uint8 data layer
+		self.array_rgba: np.ndarray = None  # Fused RGBA buffer behind the last pixmap
+		self.label_list = [1, 2, 3]
+		self.lut: np.ndarray = None  # Lookup table of label_list and alpha, see data.tools.overlay_lut
+		self.lut_key = None
+		self.scale_maps: tuple = None  # Nearest neighbour (rows, cols) source indices for the widget size
+		self.scale_key = None
 		self.pixmap_full: QPixmap = None
 		self.dataman: Datamanager = None
 		self.name = "default"
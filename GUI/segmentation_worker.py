@@ -0,0 +1,70 @@
+from PyQt5 import QtCore
+import threading
+import numpy as np
+import image.segmentation_manager as segment
+
+'''
+Runs a segmentation off the Qt main thread, so slices can still be browsed (and seeds painted) while solving.
+The job object lives in its own QThread. Everything it reports reaches the UI through queued signals.
+'''
+
+
+class SegmentationJob(QtCore.QObject):
+	'''
+	One segmentation run (segment.randomwalk_range or segment.randomwalk_single with its keyword arguments).
+	progress: stage name, step and total steps of the stage (0 if unknown). Stages are windowing, edge weights,
+	graph, solver setup and the CG iterations of each label
+	finished: label volume (H, W, N) and the image range it belongs to (result_range)
+	failed: error message, e.g. of a MemoryError
+	cancelled: the run stopped after cancel() was called. Cancellation is cooperative, the job stops at the next
+	progress report (at the latest after the running CG iteration or solver setup)
+	'''
+	progress = QtCore.pyqtSignal(str, int, int)
+	finished = QtCore.pyqtSignal(object, tuple)
+	failed = QtCore.pyqtSignal(str)
+	cancelled = QtCore.pyqtSignal()
+
+	def __init__(self, func, result_range: tuple, **kwargs):
+		super().__init__()
+		self.func = func
+		self.result_range = result_range
+		self.kwargs = kwargs
+		self.worker_thread = None
+		self.__cancel = threading.Event()
+
+	def start(self):
+		# Move the job to a new thread and run it there. The thread ends with any of the result signals
+		self.worker_thread = QtCore.QThread()
+		self.moveToThread(self.worker_thread)
+		self.worker_thread.started.connect(self.run)
+		self.finished.connect(self.worker_thread.quit)
+		self.failed.connect(self.worker_thread.quit)
+		self.cancelled.connect(self.worker_thread.quit)
+		self.worker_thread.start()
+
+	def cancel(self):
+		self.__cancel.set()
+
+	def is_running(self) -> bool:
+		return self.worker_thread is not None and self.worker_thread.isRunning()
+
+	def report(self, stage: str, step: int = 0, total: int = 0):
+		# Progress callback handed to the segmentation, runs in the worker thread
+		if self.__cancel.is_set():
+			raise segment.SegmentationCancelled()
+		self.progress.emit(stage, step, total)
+
+	@QtCore.pyqtSlot()
+	def run(self):
+		try:
+			result = self.func(progress=self.report, **self.kwargs)
+		except segment.SegmentationCancelled:
+			print("Segmentation cancelled")
+			self.cancelled.emit()
+			return
+		except Exception as e:
+			# Different exceptions might occur as an MemoryError
+			print(e)
+			self.failed.emit(str(e))
+			return
+		self.finished.emit(np.atleast_3d(result), self.result_range)
@@ -1,11 +1,14 @@
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
 from data.data_manager import Datamanager
+from data.display_cache import DisplayCache
+import data.result_export as result_export
 import image.segmentation_manager as segment
 from image.dicom_image import DicomImage
 from data.image_label import ImageLabel
 import numpy as np
 from os.path import isdir
 from data.tools import Timer
+from GUI.segmentation_worker import SegmentationJob
 import gc
 
 
@@ -51,14 +54,15 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		self.lb_preview_image.update()
 		self.update_preview_labeltext()
 
-	def update_paint_preview_label(self):
+	def update_paint_preview_label(self, rect: tuple = None):
+		# rect: changed area (x, y, width, height) of the label map, only that area gets repainted
 		label_data = self.curr_image.label.label_map
-		self.lb_preview_image.update_labelmap(label_data)
+		self.lb_preview_image.update_labelmap(label_data, rect=rect)
 		# Update paint preview area for each label separately
-		self.lb_paint_all.update_labelmap(label_data, [1, 2, 3])    # All labels from label_data
-		self.lb_paint_bg.update_labelmap(label_data, [1])           # Take only ID:1 from label_data
-		self.lb_paint_cl1.update_labelmap(label_data, [2])
-		self.lb_paint_cl2.update_labelmap(label_data, [3])
+		self.lb_paint_all.update_labelmap(label_data, [1, 2, 3], rect)    # All labels from label_data
+		self.lb_paint_bg.update_labelmap(label_data, [1], rect)           # Take only ID:1 from label_data
+		self.lb_paint_cl1.update_labelmap(label_data, [2], rect)
+		self.lb_paint_cl2.update_labelmap(label_data, [3], rect)
 
 	def update_preview(self):
 		self.lb_preview_image.update_image(self.curr_image.pixels)
@@ -76,12 +80,14 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		if not isdir(path):
 			self.le_path.setText("Please enter a valid path to an images containing folder")
 			return None
-		self.dataman.load_series(self.le_path.text(), self.pb_main)
+		self.dataman.load_series(self.le_path.text(), self.show_progress)
 		image_count = len(self.dataman.current_series)
 
 		# After loading, setup and enable relevant UI elements
 		self.dataman.last_segresult = None
 		self.dataman.last_segrange = None
+		self.__close_result_cache()
+		segment.clear_solver_cache()
 		self.sl_raw_image.setMaximum(image_count)
 		self.sl_res_image.setMaximum(image_count)
 		self.gb_paint.setEnabled(True)
@@ -105,11 +111,15 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 
 	def sl_result_image_changed(self):
 		image_nr = self.sl_res_image.value()
-		if self.dataman.last_segresult is not None and self.dataman.last_segrange[1] >= image_nr >= self.dataman.last_segrange[0]:
-			self.lb_result.update_image(self.dataman.current_series.getImage(image_nr).pixels)
-			self.lb_result.update_labelmap(
-				self.dataman.last_segresult[:, :, image_nr - self.dataman.last_segrange[0]], label_list=self.res_labelmode)
-			print("Updated to Segmentation result " + str(image_nr))
+		if self.result_cache is not None and self.dataman.last_segrange[1] >= image_nr >= self.dataman.last_segrange[0]:
+			# Display-ready slices come from the cache, which renders the neighbours ahead of the slider
+			self.lb_result.show_rgba(self.result_cache.get(image_nr, *self.result_window, self.res_labelmode,
+			                                               self.sl_res_label_alpha.value() / 100))
+
+	def __close_result_cache(self):
+		if self.result_cache is not None:
+			self.result_cache.close()
+			self.result_cache = None
 
 	def export_memtest(self, timelist, name="time_dict.csv"):
 		print(timelist)
@@ -147,50 +157,81 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 			return
 		self.export_memtest(timelist)
 
-	def __segment_range(self) -> np.ndarray:
-		try:
+	def clb_start_segment_click(self):
+		# Segmentation runs in a background job, so the UI stays usable. A click while it runs cancels it
+		if self.seg_job is not None and self.seg_job.is_running():
+			self.seg_job.cancel()
+			self.clb_start_segment.setEnabled(False)  # Until the job stopped
+			return
+		if self.rb_seg_single.isChecked():
+			# Single image segmentation
+			job = SegmentationJob(segment.randomwalk_single, self.seg_range, image=self.curr_image,
+			                      window=self.hu_window, beta_val=self.beta_val, data=self.dataman)
+		elif self.rb_seg_range.isChecked():
+			# Ranged segmentation
 			print("Segmentation range: " + str(self.seg_range))
-			return segment.randomwalk_range(self.dataman.current_series, self.seg_range, window=self.hu_window,
-			                                beta_val=self.beta_val, data=self.dataman)
-		except Exception as e:
-			print("EXCEPTION in __segment range")
-			print(e)
+			job = SegmentationJob(segment.randomwalk_range, self.seg_range, series=self.dataman.current_series,
+			                      seg_range=self.seg_range, window=self.hu_window, beta_val=self.beta_val,
+			                      data=self.dataman)
+		else:
+			return
+		job.progress.connect(self.show_progress)
+		job.finished.connect(self.segmentation_finished)
+		job.failed.connect(self.segmentation_stopped)
+		job.cancelled.connect(self.segmentation_stopped)
+		self.seg_job = job
+		self.seg_timer = Timer()
+		self.seg_timer.start()
+		self.clb_load.setEnabled(False)  # The series must not change under a running job
+		self.clb_start_segment.setText("Cancel segmentation")
+		job.start()
+
+	def show_progress(self, stage: str, step: int, total: int):
+		# Progress callback of loading and segmentation (stage, step, total)
+		# total 0: unknown length, the progress bar shows a busy indicator
+		self.pb_main.setRange(0, total)
+		self.pb_main.setValue(step)
+		self.statusBar().showMessage(stage if total == 0 else "{} ({}/{})".format(stage, step, total))
+
+	def segmentation_stopped(self, message: str = None):
+		self.seg_timer.stop()
+		self.statusBar().showMessage("Segmentation failed: " + message if message else "Segmentation cancelled")
+		self.__reset_segmentation_controls()
+
+	def segmentation_finished(self, pix_out_label: np.ndarray, seg_range: tuple):
+		self.seg_timer.stop()
+		self.statusBar().showMessage("Segmentation finished")
+		self.__reset_segmentation_controls()
+		# Store the result first, changing the slider range already shows it
+		self.dataman.last_segresult = pix_out_label
+		self.dataman.last_segrange = seg_range
+		self.__close_result_cache()
+		self.result_cache = DisplayCache(self.dataman.current_series, pix_out_label, seg_range)
+		self.result_window = self.hu_window
+		self.sl_res_image.setMaximum(seg_range[1])
+		self.sl_res_image.setMinimum(seg_range[0])
+		self.sl_result_image_changed()
+		self.gb_result.setEnabled(True)
+		self.sb_res_image_selection.setEnabled(True)
+		self.sb_res_label_alpha.setEnabled(True)
+		self.update_result_labelmode()
+		self.update()
 
-	def clb_start_segment_click(self):
-		try:
-			if self.rb_seg_single.isChecked():
-				# Single image segmentation
-				pix_out_label = segment.randomwalk_single(self.curr_image, window=self.hu_window,
-				                                          beta_val=self.beta_val, data=self.dataman)
-				self.lb_result.update_image(self.dataman.current_series.getImage(self.sl_res_image.value()).pixels)
-				self.lb_result.update_labelmap(pix_out_label)
-			elif self.rb_seg_range.isChecked():
-				# Ranged segmentation
-				timelist = list()
-				for i in range(1):  # Change to set count of segmentations for statistic time measurements
-					t = Timer()
-					t.start()
-					pix_out_label = self.__segment_range()
-					# pix_out_label = self.memtest_seg()
-					timelist.append(t.stop())
-
-				print("Time measurements:")
-				print(timelist)
-				self.lb_result.update_image(self.dataman.current_series.getImage(self.sl_res_image.value()).pixels)
-				self.lb_result.update_labelmap(pix_out_label[:, :, self.sl_res_image.value() - self.seg_range[0]])
-
-			self.sl_res_image.setMaximum(self.seg_range[1])
-			self.sl_res_image.setMinimum(self.seg_range[0])
-			self.lb_result.update_window(wc=self.hu_window[0], ww=self.hu_window[1])
-			self.dataman.last_segresult = np.atleast_3d(pix_out_label)
-			self.dataman.last_segrange = self.seg_range
-			self.gb_result.setEnabled(True)
-			self.sb_res_image_selection.setEnabled(True)
-			self.sb_res_label_alpha.setEnabled(True)
-			self.update_result_labelmode()
-			self.update()
-		except Exception as e:
-			print(e)
+	def __reset_segmentation_controls(self):
+		self.pb_main.setRange(0, 100)
+		self.pb_main.setValue(0)
+		self.clb_load.setEnabled(True)
+		self.clb_start_segment.setText(self.clb_start_segment_text)
+		self.clb_start_segment.setEnabled(True)
+
+	def closeEvent(self, e: QtGui.QCloseEvent):
+		# A running job has to end before its thread object is destroyed
+		if self.seg_job is not None and self.seg_job.is_running():
+			self.seg_job.cancel()
+			self.seg_job.worker_thread.wait()
+		self.__close_result_cache()
+		self.dataman.exporter.close()  # Pending exports are written before the program ends
+		super().closeEvent(e)
 
 	def paint_preview(self, e):
 		# handles mouse events on the preview label for painting the seeds
@@ -207,14 +248,16 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		print("Ratio: {} - {}".format(ratio_x, ratio_y))
 		x_scaled = e.x() * ratio_x
 		y_scaled = e.y() * ratio_y
-		rect_label = QtCore.QRect(x_scaled, y_scaled, self.paint_size, self.paint_size)
+		rect_label = (int(x_scaled), int(y_scaled), self.paint_size, self.paint_size)
 		print("X: {} Y: {}".format(x_scaled, y_scaled))
 
+		changed = None
 		if self.preview_paint_left:
-			self.curr_image.label.paint(self.current_paint_layer, rect_label)
+			changed = self.curr_image.label.paint(self.current_paint_layer, *rect_label)
 		elif self.preview_paint_right:
-			self.curr_image.label.unpaint(rect_label)
-		self.update_paint_preview_label()
+			changed = self.curr_image.label.unpaint(*rect_label)
+		if changed is not None:
+			self.update_paint_preview_label(changed)
 
 	def mousePressEvent_preview(self, e: QtGui.QMouseEvent):
 		if e.button() == QtCore.Qt.MouseButton.LeftButton:
@@ -235,32 +278,26 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		self.paint_preview(e)
 
 	def update_result_labelmode(self):
-		if self.lb_result.array_label is not None:
-			self.lb_result.update_transparency(self.sl_res_label_alpha.value() / 100)
-			self.lb_result.update_labelmap(self.lb_result.array_label, self.res_labelmode)
+		self.sl_result_image_changed()
 
 	def pb_clear_label_click(self):
 		self.curr_image.label.clear()
 		self.update_preview()
 
 	def pb_res_export_click(self):
-		# Exporting all segmented images to the series folder
+		# Exporting all segmented images to the series folder. The slices are rendered off-screen at native
+		# resolution from the result and the pixel data, in the window and label mode of the result view
 		export_path = self.dataman.create_export_folder(self.dataman.current_series.path)
+		if export_path is None or self.dataman.last_segresult is None:
+			return
 		print("Exporting to {}".format(export_path))
-		self.pb_main.setMinimum(self.seg_range[0])
-		self.pb_main.setMaximum(self.seg_range[1])
-		index: int = 0
 		self.dataman.export_pixmap(self.lb_preview_image.pixmap_full, name="SEEDS-WW{ww}-WC{wc}-B{beta}".format(
 			ww=self.hu_window[1], wc=self.hu_window[0], beta=self.beta_val), base_path=export_path)
-		for i in range(self.seg_range[0], self.seg_range[1] + 1):
-			# Looping through all results to "simulate" viewing, saving each result-view content as seen
-			self.pb_main.setValue(i)
-			self.lb_result.update_image(self.dataman.current_series.getImage(i).pixels)
-			label_mat = self.dataman.last_segresult[:, :, index]
-			self.lb_result.update_labelmap(label_mat, label_list=self.res_labelmode)
-			self.dataman.export_pixmap(self.lb_result.pixmap_full, name="{im}-WW{ww}-WC{wc}-B{beta}".format(
-				im=i, ww=self.hu_window[1], wc=self.hu_window[0], beta=self.beta_val), base_path=export_path)
-			index += 1
+		report = result_export.export_result(
+			self.dataman.current_series, self.dataman.last_segresult, self.dataman.last_segrange, export_path,
+			window=self.result_window, label_list=self.res_labelmode, alpha=self.sl_res_label_alpha.value() / 100,
+			name="{{im}}-WW{{ww}}-WC{{wc}}-B{beta}".format(beta=self.beta_val), progress=self.show_progress)
+		self.statusBar().showMessage("Exported {images} images, {images_per_second:.1f} images/s".format(**report))
 
 	def __init__(self):
 		super(UI_MainWindow, self).__init__()
@@ -273,6 +310,10 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		self.__beta_val = 0
 		self.__hu_window = (100, 200)
 		self.__res_labelmode = [1, 2, 3]
+		self.seg_job: SegmentationJob = None
+		self.seg_timer: Timer = None
+		self.result_cache: DisplayCache = None  # Display-ready slices of the last segmentation result
+		self.result_window = (100, 200)  # HU window (wc, ww) the result is shown with, set when it arrives
 		uic.loadUi('GUI/Main.ui', self)
 		self.sl_raw_image = self.findChild(QtWidgets.QSlider, 'sl_raw_image')
 		self.sl_raw_image.valueChanged.connect(self.update_preview)
@@ -281,6 +322,7 @@ class UI_MainWindow(QtWidgets.QMainWindow):
 		self.clb_load.clicked.connect(self.clb_load_click)
 		self.clb_start_segment = self.findChild(QtWidgets.QCommandLinkButton, 'clb_start_segment')
 		self.clb_start_segment.clicked.connect(self.clb_start_segment_click)
+		self.clb_start_segment_text = self.clb_start_segment.text()
 		###################
 		self.pb_select_folder = self.findChild(QtWidgets.QPushButton, 'pb_select_folder')
 		self.pb_select_folder.clicked.connect(self.pb_select_folder_click)
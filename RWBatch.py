@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from data.data_manager import Datamanager
+import image.segmentation_manager as segment
+try:
+	import resource  # Unix only, without it the reports have no CPU time and peak memory
+except ImportError:
+	resource = None
+
+'''
+Headless entry point: runs the segmentation jobs of a manifest without GUI (no QApplication is created).
+python RWBatch.py manifest.json [--workers N] [--out folder]
+
+The manifest is a json file {"defaults": {...}, "jobs": [{...}, ...]}, defaults apply to every job. Job keys:
+series   folder with the images of the series (as loaded by the GUI)
+seeds    .npy file, or .npz with an array "seeds", holding an (H, W, N) seed volume with the label IDs of
+         ImageLabel.LABEL_IDS. N is either the length of the series or of the range
+range    [first, last] image numbers, starting at 1 and both included. Default: whole series
+window   [wc, ww] Houndsfield window, default [100, 200]
+beta     default 130
+name     name of the result file, default: series folder name and job number
+options  further keyword arguments of segmentation_manager.randomwalk_range (mode, dtype, roi, slabs, ...)
+
+Each job writes <name>.npy, the (H, W, N) label volume of its range. report.json in the output folder lists
+status, timings (load, segmentation, write), CPU time and peak memory (not on Windows) of every job. From Python
+3.11 on every job runs in a fresh worker process, so the peak memory is the one of the job alone.
+'''
+
+JOB_DEFAULTS = {'range': None, 'window': [100, 200], 'beta': 130, 'name': None, 'options': {}}
+
+
+def load_seeds(path: str) -> np.ndarray:
+	if path.endswith(".npz"):
+		with np.load(path) as archive:
+			return archive['seeds']
+	return np.load(path)
+
+
+def run_job(job: dict, out_dir: str, load_workers: int = 1) -> dict:
+	# Load series and seeds, segment the range and save the result. Returns the report entry of the job
+	# load_workers: decoding threads of this job, its share of the cores when several jobs run at once
+	report = {'name': job['name'], 'series': job['series'], 'status': 'ok'}
+	usage_start = resource.getrusage(resource.RUSAGE_SELF) if resource is not None else None
+	t_start = time.perf_counter()
+	try:
+		data = Datamanager()
+		data.load_series(job['series'], workers=load_workers)
+		series = data.current_series
+		seg_range = tuple(job['range']) if job['range'] is not None else (1, len(series))
+		seeds = load_seeds(job['seeds'])
+		offset = 1 if seeds.shape[2] == len(series) else seg_range[0]
+		if seeds.shape[2] not in (len(series), seg_range[1] - seg_range[0] + 1):
+			raise ValueError("Seed volume of depth {} fits neither the series ({}) nor the range {}".format(
+				seeds.shape[2], len(series), seg_range))
+		for i in range(seg_range[0], seg_range[1] + 1):
+			series.getImage(i).label.label_map[...] = seeds[:, :, i - offset]
+		report['load_time'] = time.perf_counter() - t_start
+
+		t_seg = time.perf_counter()
+		seg = segment.randomwalk_range(series, seg_range, window=tuple(job['window']), beta_val=job['beta'],
+		                               data=data, **job['options'])
+		report['segmentation_time'] = time.perf_counter() - t_seg
+
+		t_write = time.perf_counter()
+		out_path = os.path.join(out_dir, job['name'] + ".npy")
+		np.save(out_path, seg)
+		report['write_time'] = time.perf_counter() - t_write
+		values, counts = np.unique(seg, return_counts=True)
+		report.update(output=out_path, range=list(seg_range), shape=list(seg.shape),
+		              label_counts={int(v): int(c) for v, c in zip(values, counts)})
+	except Exception as e:
+		print(e)
+		report.update(status='failed', error="{}: {}".format(type(e).__name__, e))
+	report['total_time'] = time.perf_counter() - t_start
+	if usage_start is not None:
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		report['cpu_time'] = (usage.ru_utime - usage_start.ru_utime) + (usage.ru_stime - usage_start.ru_stime)
+		# ru_maxrss is in bytes on macOS, in kB elsewhere
+		report['peak_rss_mb'] = usage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 1024)
+	return report
+
+
+def read_manifest(path: str) -> list:
+	with open(path, 'r') as f:
+		manifest = json.load(f)
+	base = os.path.dirname(os.path.abspath(path))  # Relative paths are relative to the manifest
+	jobs = []
+	for index, entry in enumerate(manifest['jobs']):
+		job = dict(JOB_DEFAULTS)
+		job.update(manifest.get('defaults', {}))
+		job.update(entry)
+		if 'series' not in job or 'seeds' not in job:
+			raise ValueError("Job {} needs a series and seeds".format(index + 1))
+		job['series'] = os.path.join(base, job['series'])
+		job['seeds'] = os.path.join(base, job['seeds'])
+		if job['name'] is None:
+			job['name'] = "{}-{}".format(os.path.basename(os.path.normpath(job['series'])), index + 1)
+		jobs.append(job)
+	return jobs
+
+
+def run_batch(jobs: list, out_dir: str, workers: int = 1) -> list:
+	# One process per job (max_tasks_per_child=1, Python 3.11+), at most workers at the same time. Before 3.11
+	# workers are reused for several jobs, peak memory then is the one of all jobs of that worker so far.
+	# Reports in manifest order
+	os.makedirs(out_dir, exist_ok=True)
+	t_start = time.perf_counter()
+	reports = [None] * len(jobs)
+	load_workers = max(1, (os.cpu_count() or 1) // workers)  # Jobs running together share the cores
+	fresh_workers = {'max_tasks_per_child': 1} if sys.version_info >= (3, 11) else {}
+	with ProcessPoolExecutor(max_workers=workers, **fresh_workers) as pool:
+		futures = {pool.submit(run_job, job, out_dir, load_workers): index for index, job in enumerate(jobs)}
+		for future in as_completed(futures):
+			index = futures[future]
+			try:
+				reports[index] = future.result()
+			except Exception as e:
+				# The worker itself died, e.g. killed for running out of memory
+				reports[index] = {'name': jobs[index]['name'], 'series': jobs[index]['series'], 'status': 'failed',
+				                  'error': "{}: {}".format(type(e).__name__, e)}
+			print("Job {} {}".format(reports[index]['name'], reports[index]['status']))
+	summary = {'jobs': len(jobs), 'failed': sum(r['status'] != 'ok' for r in reports), 'workers': workers,
+	           'wall_time': time.perf_counter() - t_start}
+	with open(os.path.join(out_dir, "report.json"), 'w') as f:
+		json.dump({'summary': summary, 'jobs': reports}, f, indent=2)
+	print("{jobs} jobs, {failed} failed, {wall_time:.1f}s with {workers} workers".format(**summary))
+	return reports
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Headless batch random walker segmentation")
+	parser.add_argument("manifest", help="json file with the jobs")
+	parser.add_argument("--workers", type=int, default=1, help="jobs running at the same time")
+	parser.add_argument("--out", default="batch_output", help="folder for label volumes and report.json")
+	args = parser.parse_args()
+	run_batch(read_manifest(args.manifest), args.out, workers=args.workers)
@@ -3,9 +3,11 @@ from GUI import ui_main
 
 '''
 Main entry point to run the program
+--debug-export writes the intermediate images of the widgets and the segmentation into export/<date>
 '''
 if __name__ == "__main__":
 	import sys
 	app = QtWidgets.QApplication(sys.argv)
 	window = ui_main.UI_MainWindow()
+	window.dataman.debug_export = "--debug-export" in sys.argv
 	app.exec_()
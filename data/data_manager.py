@@ -1,38 +1,13 @@
-from PyQt5.QtCore import QFile, QIODevice
-from PyQt5.QtGui import QPixmap
 from data.dicom_series import DicomSeries
+from data.slice_cache import SliceCache
+import data.volume_cache as volume_cache
+from data.export_queue import ExportQueue
 from image.dicom_image import DicomImage
-from PyQt5.QtWidgets import QProgressBar
-import os, time, random, re, threading, pathlib
-from matplotlib import pyplot
+import os, time, random, re, pathlib
 from typing import Tuple
 import numpy as np
 
 
-class ExportWriter(object):
-	def __init__(self, data, path):
-		self.data = data
-		self.path = path
-		thread = threading.Thread(target=self.run, args=())
-		thread.start()
-
-	def run(self):
-		try:
-			if type(self.data) is not list:
-				all_obj = [self.data]
-			for i in all_obj:
-				if type(i) == QPixmap:
-					f: QFile = QFile(self.path)
-					f.open(QIODevice.WriteOnly)
-					i.save(f, "PNG")
-				elif type(self.data) == np.ndarray:
-					pyplot.imsave(self.path, i)
-		except ValueError as ve:
-			return  # Expected sometimes, cause not fully reviewed
-		except Exception as e:
-			print(e)
-
-
 def getDateString():
 	return time.strftime("%d.%m %H-%M-%S", time.localtime())
 
@@ -46,22 +21,35 @@ class Datamanager:
 		self.export_names: dict = {}
 		self.last_segresult: np.ndarray = None
 		self.last_segrange: tuple = None
-
-	def getPixelLabel3D(self, series: DicomSeries = None, im_range: tuple = (1, None)) -> Tuple[np.ndarray, np.ndarray]:
+		self.cache_dir: str = os.path.join(self.base_dir, "volume_cache")  # Used by load_series(disk_cache=True)
+		# Debug exports (no base_path, into the per run folder) are skipped unless switched on
+		self.debug_export: bool = False
+		self.exporter: ExportQueue = ExportQueue()
+
+	def getPixelLabel3D(self, series: DicomSeries = None, im_range: tuple = (1, None),
+	                    copy: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+		# Returns (H, W, N) pixel and label volume for the image range (numbering starts at 1, end included).
+		# With copy=False and a series that is held contiguously, views into the series storage are returned
 		if series is None:
 			series = self.current_series
 		if im_range[1] is None:
-			im_range = im_range(im_range[0], len(series))
-		first_im: DicomImage = series.getImage(im_range[0])
+			im_range = (im_range[0], len(series))
+		start, end = im_range
+		if end < start:
+			raise ValueError("Invalid image range {}".format(im_range))
+		if not copy and series.pixel_volume is not None and series.label_volume is not None:
+			return series.pixel_volume[:, :, start - 1:end], series.label_volume[:, :, start - 1:end]
+		first_im: DicomImage = series.getImage(start)
 		dims = first_im.dims
-		vol: np.ndarray = first_im.pixels
-		label: np.ndarray = first_im.label.label_map
-		for i in range(im_range[0] + 1, im_range[1] + 1):
+		# Allocate the whole stack once and fill it slice by slice instead of growing it with np.dstack
+		vol: np.ndarray = np.empty((dims[0], dims[1], end - start + 1), dtype=first_im.pixels.dtype)
+		label: np.ndarray = np.empty((dims[0], dims[1], end - start + 1), dtype=first_im.label.label_map.dtype)
+		for index, i in enumerate(range(start, end + 1)):
 			image: DicomImage = series.getImage(i)
-			c_pixel: np.ndarray = image.pixels
-			c_label: np.ndarray = image.label.label_map
-			vol = np.dstack((vol, c_pixel))
-			label = np.dstack((label, c_label))
+			if image.dims != dims:
+				raise ValueError("Image {} has dimensions {}, expected {}".format(i, image.dims, dims))
+			vol[:, :, index] = image.pixels
+			label[:, :, index] = image.label.label_map
 		return vol, label
 
 	def getImage(self, number):
@@ -112,6 +100,8 @@ class Datamanager:
 
 	def __get_export_fname(self, name, folder=None):
 		# Generating semi-unique filename in the currently used debug image folder
+		if folder is None and self.current_export_path is None:
+			self.create_series_folder()  # Debug export switched on after loading
 		if folder is None and self.current_export_path is None:
 			raise Exception("Path is not existent")
 		elif folder is None:
@@ -130,21 +120,37 @@ class Datamanager:
 		return path
 
 	def export_np(self, arr: np.ndarray, name: str = None, base_path=None):
-		# Exporting a Numpy Array as an image
+		# Exporting a Numpy Array as an image. Written in the background by self.exporter
+		if base_path is None and not self.debug_export:
+			return
 		path = self.__get_export_fname(name, base_path)
-		ExportWriter(arr, path)
+		# Debug frames of the same name coalesce in the queue, the array is copied as it might change meanwhile
+		self.exporter.submit(np.array(arr), path, key=name if base_path is None else None)
 
-	def export_pixmap(self, pix: QPixmap, name: str = None, base_path=None):
-		# Exporting an QPixmap to an image file
+	def export_pixmap(self, pix: 'QPixmap', name: str = None, base_path=None):
+		# Exporting an QPixmap to an image file. Written in the background by self.exporter
+		if base_path is None and not self.debug_export:
+			return
 		try:
 			path = self.__get_export_fname(name, base_path)
-			ExportWriter(pix, path)
+			# Converted here, QPixmaps only live in the GUI thread
+			self.exporter.submit(pix.toImage(), path, key=name if base_path is None else None)
 		except Exception as e:
 			print(e)
 			print("Error saving Pixmap")
 
-	def load_series(self, path, pb: QProgressBar = None):
+	def load_series(self, path, progress=None, contiguous: bool = False, workers: int = None,
+	                executor: str = 'thread', lazy: bool = False, cache_budget: int = 512 * 2 ** 20,
+	                disk_cache: bool = False):
 		# New folder gets scanned, packed into dicom_series object. Loading of data called in dicom_image
+		# progress: optional callback progress(stage, step, total), e.g. the GUI progress bar
+		# contiguous: hold all pixels/labels of the series in one volume (see DicomSeries.consolidate)
+		# workers/executor: decoding pool for DicomSeries.load_all, defaults to one worker per core
+		# lazy: only scan headers, decode on access into an LRU cache of cache_budget bytes
+		# disk_cache: memory-map the decoded volume from self.cache_dir, (re)build it if missing or stale.
+		# Implies contiguous storage
+		if lazy and (contiguous or disk_cache):
+			raise ValueError("Lazy loading and contiguous storage can not be combined")
 		new_s = DicomSeries(path)
 		print('Path to the DICOM directory: {}'.format(path))
 		image_list: DicomImage = []
@@ -160,7 +166,29 @@ class Datamanager:
 			break
 		new_s.images = image_list
 		print("{} images found. Start loading".format(len(image_list)))
-		new_s.load_all(pb)
+		file_paths = [i.path for i in image_list]
+		cached = volume_cache.load(self.cache_dir, path, file_paths) if disk_cache else None
+		if cached is not None:
+			print("Loading from volume cache")
+			new_s.load_volume(cached[0], cached[1]['dicom_format'])
+			failed = []
+		elif lazy:
+			failed = new_s.load_headers(SliceCache(cache_budget), progress)
+		else:
+			if workers is None:
+				workers = os.cpu_count() or 1
+			failed = new_s.load_all(progress, workers=workers, executor=executor)
+		if len(failed) > 0:
+			print("{} images could not be loaded: {}".format(len(failed), failed))
+		if (contiguous or disk_cache) and cached is None:
+			try:
+				new_s.consolidate()
+				print("Series held contiguously, {:.1f} MB".format(new_s.nbytes / 2 ** 20))
+				if disk_cache and volume_cache.store(self.cache_dir, path, file_paths, new_s):
+					print("Volume cache written")
+			except ValueError as e:
+				print(e)
 		print("Everything loaded")
-		self.create_series_folder()
+		if self.debug_export:
+			self.create_series_folder()
 		self.current_series = new_s
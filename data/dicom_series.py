@@ -1,5 +1,8 @@
+import multiprocessing
 from image import dicom_image
-from PyQt5.QtWidgets import QProgressBar
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from data.slice_cache import SliceCache
 
 
 class DicomSeries:
@@ -8,18 +11,118 @@ class DicomSeries:
 	def getImage(self, number: int):  # Image numbering starts at 1
 		if number > len(self.images):
 			raise ValueError("Requested image number is not present in series")
-		return self.images[number - 1]
-
-	def load_all(self, pb: QProgressBar = None):
-		# Loop over all images and let them load the content themselves while updating ProgressBar
-		if pb is not None:
-			pb.setMinimum(0)
-			pb.setValue(0)
-			pb.setMaximum(len(self.images))
-		for i in self.images:
-			i.load_content()
-			if pb is not None:
-				pb.setValue(pb.value() + 1)
+		image = self.images[number - 1]
+		if self.cache is not None:
+			image.pixels  # Lazy series: decode on first access
+		return image
+
+	def load_headers(self, cache: SliceCache, progress=None) -> list:
+		# Lazy mode: scan only headers, pixels are decoded on first access and kept in the bounded cache
+		# progress: optional callback progress(stage, step, total), as used by the segmentation
+		self.cache = cache
+		self.failed = []
+		total = len(self.images)
+		if progress is not None:
+			progress("Reading headers", 0, total)
+		for index, i in enumerate(self.images):
+			i.load_header(cache)
+			if not i.loaded:
+				self.failed.append(i.path)
+			if progress is not None:
+				progress("Reading headers", index + 1, total)
+		return self.failed
+
+	def pin_range(self, im_range: tuple):
+		# Keep the pixels of images in the range (numbering starts at 1, end included) in the cache
+		if self.cache is not None:
+			self.cache.pin_range(self.images[im_range[0] - 1:im_range[1]])
+
+	def unpin(self):
+		# Release the pinned range, its pixels are evicted like any other
+		if self.cache is not None:
+			self.cache.pin_range([])
+
+	def load_all(self, progress=None, workers: int = 1, executor: str = 'thread') -> list:
+		# Loop over all images and let them load the content themselves while reporting progress(stage, step, total).
+		# workers > 1 decodes in a pool ('thread' or 'process'). Slice order is kept, the callback is only
+		# called from the calling thread. Returns the paths that failed to load, the rest of the series stays usable
+		self.failed = []
+		total = len(self.images)
+		if progress is not None:
+			progress("Loading images", 0, total)
+		if workers is None or workers <= 1:
+			for index, i in enumerate(self.images):
+				i.load_content()
+				if not i.loaded:
+					self.failed.append(i.path)
+				if progress is not None:
+					progress("Loading images", index + 1, total)
+			return self.failed
+		if executor == 'thread':
+			pool = ThreadPoolExecutor(max_workers=workers)
+		elif executor == 'process':
+			# Spawned, not forked: loading runs in the GUI process, which has Qt and other threads running
+			pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+		else:
+			raise ValueError("Unknown executor '{}', use 'thread' or 'process'".format(executor))
+		keep_header = executor == 'thread'
+		with pool:
+			futures = {pool.submit(dicom_image.read_file, i.path, keep_header): i for i in self.images}
+			for done, future in enumerate(as_completed(futures)):
+				image: dicom_image.DicomImage = futures[future]
+				try:
+					image.set_content(*future.result())
+				except Exception as e:
+					print(e)
+					print(f"Error loading image {image.path}")
+					image.loaded = False
+					self.failed.append(image.path)
+				if progress is not None:
+					progress("Loading images", done + 1, total)
+		return self.failed
+
+	def consolidate(self):
+		# Move all pixels and labels into one contiguous (H, W, N) int16 / int8 storage. Afterwards every
+		# DicomImage.pixels and ImageLabel.label_map is a view into that storage, slice i at [:, :, i - 1]
+		if self.cache is not None:
+			raise ValueError("Lazily loaded series can not be held contiguously")
+		loaded = [i for i in self.images if i.loaded]
+		if len(loaded) != len(self.images):
+			raise ValueError("Series can only be held contiguously if all images are loaded")
+		dims = self.images[0].dims
+		if any(i.dims != dims for i in self.images):
+			raise ValueError("Series can only be held contiguously if all images share their dimensions")
+		pixel_volume = np.empty((dims[0], dims[1], len(self.images)), dtype=np.int16)
+		label_volume = np.empty((dims[0], dims[1], len(self.images)), dtype=np.int8)
+		for index, image in enumerate(self.images):
+			pixel_volume[:, :, index] = image.pixels
+			label_volume[:, :, index] = image.label.label_map
+		self.__bind_volume(pixel_volume, label_volume)
+
+	def load_volume(self, pixel_volume: np.ndarray, dicom_format: list = None):
+		# Take the content of all images from an already decoded (H, W, N) volume, e.g. a memory-mapped disk
+		# cache. The series is held contiguously afterwards with an empty label volume
+		if pixel_volume.shape[2] != len(self.images):
+			raise ValueError("Volume holds {} slices, series has {} images".format(pixel_volume.shape[2], len(self.images)))
+		for index, image in enumerate(self.images):
+			image.set_content(pixel_volume[:, :, index], True if dicom_format is None else dicom_format[index])
+		self.__bind_volume(pixel_volume, np.zeros(pixel_volume.shape, dtype=np.int8))
+
+	def __bind_volume(self, pixel_volume: np.ndarray, label_volume: np.ndarray):
+		for index, image in enumerate(self.images):
+			image.pixels = pixel_volume[:, :, index]
+			image.label.label_map = label_volume[:, :, index]
+		self.pixel_volume = pixel_volume
+		self.label_volume = label_volume
+
+	@property
+	def nbytes(self) -> int:
+		# Memory held by pixel and label data of this series
+		if self.pixel_volume is not None:
+			return self.pixel_volume.nbytes + self.label_volume.nbytes
+		if self.cache is not None:
+			return self.cache.nbytes + sum(i.label.label_map.nbytes for i in self.images if i.loaded)
+		return sum(i.pixels.nbytes + i.label.label_map.nbytes for i in self.images if i.loaded)
 
 	def __len__(self):
 		return len(self.images)
@@ -27,3 +130,8 @@ class DicomSeries:
 	def __init__(self, path: str):
 		self.path: str = path
 		self.images: [dicom_image] = None
+		self.failed: [str] = []  # Paths which could not be loaded by load_all
+		self.cache: SliceCache = None  # Only set for lazily loaded series
+		# Optional contiguous (H, W, N) storage of all pixels/labels. None while images own their arrays
+		self.pixel_volume: np.ndarray = None
+		self.label_volume: np.ndarray = None
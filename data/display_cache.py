@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+import data.tools as imf
+from data.image_label import ImageLabel
+
+
+class DisplayCache:
+	'''
+	Bounded LRU store of display-ready slices of a segmentation result, for browsing it with the result slider.
+	Entries are unscaled (H, W, 4) RGBA buffers (data.tools.render_overlay: windowed pixels with the fused labels),
+	keyed by (image number, wc, ww, label list, alpha). Changing window, label mode or alpha therefore just misses.
+	get() renders on a miss and queues the neighbouring slices in the direction of the last move, a background
+	thread renders them ahead of the slider. Least recently used slices are dropped beyond the byte budget.
+	'''
+
+	def get(self, image_nr: int, wc: int, ww: int, label_list, alpha: float) -> np.ndarray:
+		# Image numbering starts at 1, image_nr has to be in result_range
+		key = self.__key(image_nr, wc, ww, label_list, alpha)
+		with self.lock:
+			rgba = self.entries.get(key)
+			if rgba is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+		if rgba is None:
+			rgba = self.__render(key)
+			self.__add(key, rgba)
+			with self.lock:
+				self.misses += 1
+		self.__queue_neighbours(key)
+		return rgba
+
+	def close(self):
+		# Stop the prefetch thread and drop all slices
+		with self.wakeup:
+			self.closed = True
+			self.pending = []
+			self.wakeup.notify()
+		self.thread.join()
+		with self.lock:
+			self.entries.clear()
+			self.nbytes = 0
+
+	def __key(self, image_nr, wc, ww, label_list, alpha) -> tuple:
+		if not self.result_range[0] <= image_nr <= self.result_range[1]:
+			raise ValueError("Image {} is not part of the result {}".format(image_nr, self.result_range))
+		return image_nr, wc, ww, tuple(label_list), alpha
+
+	def __render(self, key: tuple) -> np.ndarray:
+		image_nr, wc, ww, label_list, alpha = key
+		with self.lock:
+			lut = self.luts.get((label_list, alpha))
+		if lut is None:
+			lut = imf.overlay_lut(self.colors, label_list, alpha)
+			with self.lock:
+				self.luts[(label_list, alpha)] = lut
+		window = imf.arr_hu_to_arr(self.series.getImage(image_nr).pixels, ww=ww, wc=wc, dtype=np.uint8)
+		return imf.render_overlay(self.result[:, :, image_nr - self.result_range[0]], lut, window)
+
+	def __add(self, key: tuple, rgba: np.ndarray):
+		with self.lock:
+			if key in self.entries:
+				return
+			self.entries[key] = rgba
+			self.nbytes += rgba.nbytes
+			while self.nbytes > self.budget and len(self.entries) > 1:
+				self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+				self.evictions += 1
+
+	def __queue_neighbours(self, key: tuple):
+		# Slices ahead in the direction of the last move first, then a few behind. Replaces older requests
+		image_nr = key[0]
+		step = -1 if self.last_nr is not None and image_nr < self.last_nr else 1
+		self.last_nr = image_nr
+		order = [image_nr + step * i for i in range(1, self.prefetch + 1)] + \
+		        [image_nr - step * i for i in range(1, self.prefetch // 2 + 1)]
+		keys = [(nr,) + key[1:] for nr in order if self.result_range[0] <= nr <= self.result_range[1]]
+		with self.wakeup:
+			self.pending = keys
+			self.wakeup.notify()
+
+	def __run(self):
+		while True:
+			with self.wakeup:
+				while not self.pending and not self.closed:
+					self.wakeup.wait()
+				if self.closed:
+					return
+				key = self.pending.pop(0)
+			with self.lock:
+				cached = key in self.entries
+			if not cached:
+				try:
+					self.__add(key, self.__render(key))
+				except Exception as e:
+					print(e)
+					print("Error prefetching image {}".format(key[0]))
+					continue
+				with self.lock:
+					self.prefetched += 1
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __init__(self, series, result: np.ndarray, result_range: tuple, budget: int = 256 * 2 ** 20,
+	             prefetch: int = 4, colors: dict = ImageLabel.LABEL_COLORS):
+		self.series = series
+		self.result: np.ndarray = result  # (H, W, N) label volume of result_range (numbering starts at 1, end included)
+		self.result_range: tuple = result_range
+		self.budget: int = budget  # Upper bound of cached RGBA bytes
+		self.prefetch: int = prefetch  # Slices rendered ahead of the slider
+		self.colors: dict = colors
+		self.nbytes: int = 0
+		self.entries: OrderedDict = OrderedDict()
+		self.luts: dict = {}  # (label list, alpha) -> data.tools.overlay_lut
+		self.lock = threading.RLock()
+		self.wakeup = threading.Condition()
+		self.pending: list = []
+		self.closed = False
+		self.last_nr: int = None
+		self.hits = 0
+		self.misses = 0
+		self.prefetched = 0
+		self.evictions = 0
+		self.thread = threading.Thread(target=self.__run, daemon=True)
+		self.thread.start()
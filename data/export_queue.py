@@ -0,0 +1,104 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+
+
+class ExportQueue:
+	'''
+	Writes exported images in the background: one bounded queue, a fixed pool of writer threads.
+	Items are numpy arrays (written with matplotlib.image.imsave) or objects with a save(path, format) method
+	such as a QImage. Pass QImages, not QPixmaps, a QPixmap must not be used outside the GUI thread.
+	Frames submitted with a key (e.g. debug exports of a widget) are stale as soon as a newer frame with the same
+	key arrives: a pending one is replaced, and when the queue is full the oldest keyed frame is dropped. Frames
+	without a key are never dropped, submit blocks until there is space for them.
+	'''
+
+	def submit(self, item, path: str, key=None):
+		with self.changed:
+			if key is not None and ('key', key) in self.pending:
+				self.pending[('key', key)] = (item, path)
+				self.coalesced += 1
+				return
+			while len(self.pending) >= self.maxsize:
+				stale = next((k for k in self.pending if k[0] == 'key'), None)
+				if stale is not None:
+					del self.pending[stale]
+					self.dropped += 1
+				elif key is not None:
+					self.dropped += 1  # Queue is full of frames that must be written, the new one is stale soonest
+					return
+				else:
+					self.changed.wait()
+			self.count += 1
+			self.pending[('key', key) if key is not None else ('seq', self.count)] = (item, path)
+			self.__start_workers()
+			self.changed.notify_all()
+
+	def flush(self):
+		# Block until everything submitted so far is written
+		with self.changed:
+			while self.pending or self.busy:
+				self.changed.wait()
+
+	def close(self):
+		self.flush()
+		with self.changed:
+			self.closed = True
+			self.changed.notify_all()
+		for t in self.threads:
+			t.join()
+		self.threads = []
+
+	def __start_workers(self):
+		# Threads are only started on the first export
+		while len(self.threads) < self.workers and not self.closed:
+			thread = threading.Thread(target=self.__run, daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+	def __run(self):
+		while True:
+			with self.changed:
+				while not self.pending and not self.closed:
+					self.changed.wait()
+				if not self.pending:
+					return
+				item, path = self.pending.popitem(last=False)[1]
+				self.busy += 1
+				self.changed.notify_all()  # Space for blocked submits
+			try:
+				self.__write(item, path)
+				written = True
+			except Exception as e:
+				print(e)
+				print("Error exporting {}".format(path))
+				written = False
+			with self.changed:
+				self.busy -= 1
+				if written:
+					self.written += 1
+				else:
+					self.failed += 1
+				self.changed.notify_all()
+
+	@staticmethod
+	def __write(item, path: str):
+		if isinstance(item, np.ndarray):
+			from matplotlib import image  # Not pyplot, that would pick a GUI backend
+			image.imsave(path, item)
+		elif not item.save(path, "PNG"):
+			raise IOError("Could not write image")
+
+	def __init__(self, workers: int = 2, maxsize: int = 32):
+		self.workers: int = workers
+		self.maxsize: int = maxsize  # Upper bound of images waiting to be written
+		self.pending: OrderedDict = OrderedDict()  # ('key', key) or ('seq', n) -> (item, path), oldest first
+		self.changed = threading.Condition()
+		self.threads: list = []
+		self.busy = 0
+		self.closed = False
+		self.count = 0
+		self.written = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.failed = 0
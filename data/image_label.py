@@ -1,6 +1,4 @@
-from PyQt5.QtCore import QRect
 import numpy as np
-from PyQt5.QtGui import QColor
 
 
 def clamp(n, minn, maxn):
@@ -10,30 +8,37 @@ def clamp(n, minn, maxn):
 class ImageLabel:
 	# Each label class gets an own ID as an integer for representation in matrices
 	# Color of each label is determined here, so that every module can access it with no confusion.
+	# Plain (r, g, b) tuples, overlays map them to RGBA through data.tools.overlay_lut
 	LABEL_IDS = {'NONE': 0, 'BG': 1, 'CL1': 2, 'CL2': 3}
-	color_bg: QColor = QColor('green')
-	color_cl1: QColor = QColor('red')
-	color_cl2: QColor = QColor('blue')
+	color_bg: tuple = (0, 128, 0)  # green
+	color_cl1: tuple = (255, 0, 0)  # red
+	color_cl2: tuple = (0, 0, 255)  # blue
 	LABEL_COLORS = {'1': color_bg, '2': color_cl1, '3': color_cl2}
 
 	def __init__(self, dims):
 		self.dims = dims
 		self.label_map: np.ndarray = np.zeros(dims, dtype=np.int8)
 
-	def unpaint(self, rect: QRect):
+	def unpaint(self, x: int, y: int, width: int, height: int):
 		# "paint" a square of ID: NONE to the storage to "unpaint" it
-		self.paint(self.LABEL_IDS['NONE'], rect)
+		return self.paint(self.LABEL_IDS['NONE'], x, y, width, height)
 
-	def paint(self, layer_id, rect: QRect):
+	def paint(self, layer_id, x: int, y: int, width: int, height: int):
+		# Rectangle in pixel coordinates of the label map, top left corner x, y. Returns the changed rectangle
+		# (x, y, width, height), clipped to the label map, or None if nothing changed
 		if layer_id not in self.LABEL_IDS.values():
 			print(f"{layer_id} not in LayerList")
-		else:
-			topleftX = rect.x()
-			topleftY = rect.y()
-			bottomrightX = topleftX + rect.width()
-			bottomrightY = topleftY + rect.height()
-			# print(f"Layer {layer_id}. TopLeft {topleftX},{topleftY} - BottomRight {bottomrightX},{bottomrightY}")
-			self.label_map[topleftY:bottomrightY, topleftX:bottomrightX] = layer_id # Replacing data in storage matrix
+			return None
+		topleftX = clamp(int(x), 0, self.label_map.shape[1])
+		topleftY = clamp(int(y), 0, self.label_map.shape[0])
+		bottomrightX = clamp(int(x) + int(width), 0, self.label_map.shape[1])
+		bottomrightY = clamp(int(y) + int(height), 0, self.label_map.shape[0])
+		if bottomrightX <= topleftX or bottomrightY <= topleftY:
+			return None
+		# print(f"Layer {layer_id}. TopLeft {topleftX},{topleftY} - BottomRight {bottomrightX},{bottomrightY}")
+		self.label_map[topleftY:bottomrightY, topleftX:bottomrightX] = layer_id # Replacing data in storage matrix
+		return topleftX, topleftY, bottomrightX - topleftX, bottomrightY - topleftY
 
 	def clear(self):
-		self.label_map: np.ndarray = np.zeros(self.dims, dtype=np.int8)
+		# Reset in place, label_map might be a view into the series label volume
+		self.label_map[...] = self.LABEL_IDS['NONE']
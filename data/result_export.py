@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import numpy as np
+from PIL import Image
+import data.tools as imf
+from data.image_label import ImageLabel
+
+'''
+Headless export of a segmentation result: every slice of the range is rendered at native resolution straight from
+the pixel data and the label volume (HU window plus fused label colors, data.tools.render_overlay) and written as
+PNG. Rendering and encoding run in a process pool, no widget or QApplication is involved.
+'''
+
+
+def write_slice(pixels: np.ndarray, labels: np.ndarray, lut: np.ndarray, window: tuple, path: str,
+                compress_level: int = 1) -> int:
+	# Render and write one slice, returns the size of the written file. window: (wc, ww)
+	grey = imf.arr_hu_to_arr(pixels, ww=window[1], wc=window[0], dtype=np.uint8)
+	rgba = imf.render_overlay(labels, lut, grey)
+	Image.fromarray(rgba[:, :, :3], 'RGB').save(path, compress_level=compress_level)
+	return os.path.getsize(path)
+
+
+def export_result(series, result: np.ndarray, result_range: tuple, out_dir: str, window: tuple,
+                  label_list=(1, 2, 3), alpha: float = 1.0, name: str = "{im}-WW{ww}-WC{wc}",
+                  workers: int = None, compress_level: int = 1, volume: bool = False, progress=None) -> dict:
+	'''
+	Write one PNG per image of result_range (numbering starts at 1, end included) into out_dir.
+	:param result: (H, W, N) label volume of result_range, e.g. Datamanager.last_segresult
+	:param window: HU window (wc, ww) of the data layer
+	:param label_list, alpha: shown labels and their strength, as in the result view
+	:param name: file name format, fields im (image number), wc and ww
+	:param workers: encoding processes, defaults to one per core. 1 writes in the calling process
+	:param volume: also write the whole label volume as compressed labels.npz (arrays labels and result_range)
+	:param progress: optional callback progress(stage, step, total)
+	:return: report with number of images, bytes written, seconds and throughput
+	'''
+	if result.shape[2] != result_range[1] - result_range[0] + 1:
+		raise ValueError("Result of depth {} does not fit the range {}".format(result.shape[2], result_range))
+	os.makedirs(out_dir, exist_ok=True)
+	if workers is None:
+		workers = os.cpu_count() or 1
+	lut = imf.overlay_lut(ImageLabel.LABEL_COLORS, label_list, alpha)
+	t_start = time.perf_counter()
+	total = result.shape[2]
+	nbytes = 0
+	failed = []
+
+	def jobs():
+		for index, image_nr in enumerate(range(result_range[0], result_range[1] + 1)):
+			path = os.path.join(out_dir, name.format(im=image_nr, wc=window[0], ww=window[1]) + ".png")
+			yield image_nr, (series.getImage(image_nr).pixels, result[:, :, index], lut, window, path, compress_level)
+
+	def collect(future) -> int:
+		nonlocal done
+		image_nr = futures.pop(future)
+		done += 1
+		if progress is not None:
+			progress("Exporting images", done, total)
+		try:
+			return future.result()
+		except Exception as e:
+			print(e)
+			failed.append(image_nr)
+			return 0
+
+	if progress is not None:
+		progress("Exporting images", 0, total)
+	if workers <= 1:
+		for done, (image_nr, args) in enumerate(jobs()):
+			try:
+				nbytes += write_slice(*args)
+			except Exception as e:
+				print(e)
+				failed.append(image_nr)
+			if progress is not None:
+				progress("Exporting images", done + 1, total)
+	else:
+		# At most two slices per worker in flight, the pixels of the whole range are never copied at once
+		done = 0
+		futures = {}
+		# Spawned, not forked: the caller may be the GUI with Qt and writer threads running, which a fork copies
+		with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+			for image_nr, args in jobs():
+				futures[pool.submit(write_slice, *args)] = image_nr
+				if len(futures) < 2 * workers:
+					continue
+				finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+				for future in finished:
+					nbytes += collect(future)
+			for future in as_completed(futures):
+				nbytes += collect(future)
+	if volume:
+		volume_path = os.path.join(out_dir, "labels.npz")
+		np.savez_compressed(volume_path, labels=result, result_range=np.asarray(result_range))
+		nbytes += os.path.getsize(volume_path)
+	seconds = time.perf_counter() - t_start
+	report = {'images': total - len(failed), 'failed': sorted(failed), 'bytes': nbytes, 'seconds': seconds,
+	          'images_per_second': (total - len(failed)) / seconds if seconds > 0 else 0.0,
+	          'mb_per_second': nbytes / 2 ** 20 / seconds if seconds > 0 else 0.0, 'workers': workers}
+	print("Exported {images} images to {dir}: {seconds:.2f}s, {images_per_second:.1f} images/s, "
+	      "{mb_per_second:.1f} MB/s".format(dir=out_dir, **report))
+	return report
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+
+
+class SliceCache:
+	'''
+	Bounded LRU store for decoded pixel data of lazily loaded images (see DicomImage.load_header).
+	Images register themselves on decode, the cache drops the pixels of the least recently used images as soon
+	as the byte budget is exceeded. Eviction order:
+	1. unpinned images without seeds
+	2. unpinned images with seeds painted on them
+	Images inside the pinned range (active segmentation range) are never evicted. Label maps are not part of
+	the cache and always stay in memory.
+	'''
+
+	def add(self, image, nbytes: int):
+		with self.lock:
+			if image in self.entries:
+				self.nbytes -= self.entries[image]
+			self.entries[image] = nbytes
+			self.entries.move_to_end(image)
+			self.nbytes += self.entries[image]
+			self.misses += 1
+			self.__evict(keep=image)
+
+	def touch(self, image):
+		with self.lock:
+			if image in self.entries:
+				self.entries.move_to_end(image)
+				self.hits += 1
+
+	def pin_range(self, images: list):
+		# Pin the pixels of the given images (e.g. active segmentation range), previous pins are released
+		with self.lock:
+			self.pinned = set(images)
+
+	def is_pinned(self, image) -> bool:
+		return image in self.pinned
+
+	def clear(self):
+		with self.lock:
+			for image in self.entries:
+				image.drop_pixels()
+			self.entries.clear()
+			self.nbytes = 0
+
+	def __evict(self, keep=None):
+		# First pass only takes images without seeds, second pass whatever is left unpinned. Oldest first
+		for allow_labeled in (False, True):
+			for image in list(self.entries):
+				if self.nbytes <= self.budget:
+					return
+				if image is keep or image in self.pinned:
+					continue
+				if not allow_labeled and image.label is not None and np.any(image.label.label_map):
+					continue
+				self.nbytes -= self.entries.pop(image)
+				image.drop_pixels()
+				self.evictions += 1
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __init__(self, budget: int = 512 * 2 ** 20):
+		self.budget: int = budget   # Upper bound of cached pixel bytes
+		self.nbytes: int = 0
+		self.entries: OrderedDict = OrderedDict()
+		self.pinned: set = set()
+		self.lock = threading.RLock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
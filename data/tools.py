@@ -15,11 +15,38 @@ def window_hu(raw, wc, ww):
 	return target
 
 
-def arr_hu_to_arr(array: np.ndarray, ww: int, wc: int) -> np.ndarray:
-	# Use numpy.vectorize to apply window function on each cell
-	hu_func = lambda h: window_hu(h, ww=ww, wc=wc)
-	vect_hu = np.vectorize(hu_func)
-	return vect_hu(array)
+def arr_hu_to_arr(array: np.ndarray, ww: int, wc: int, dtype=np.float64, out: np.ndarray = None) -> np.ndarray:
+	# Array version of window_hu. Same DICOM window formula, but evaluated as clip(scale(raw)) on the whole array.
+	# Works on one float buffer in place and casts at the end: uint8 for display, float32/float64 for the solver.
+	# "out" can be passed to reuse a buffer of matching shape and dtype between calls (e.g. slider moves)
+	# The result is float64 by default. The former np.vectorize(window_hu) inferred its type from the first pixel:
+	# int64 (truncated, up to one intensity step lower) if that pixel was clipped to 0/255, float64 otherwise.
+	# Segmentation input can therefore differ slightly from results computed before
+	_min = 0
+	_max = 255
+	dtype = np.dtype(dtype)
+	work_type = dtype if dtype.kind == 'f' else np.dtype(np.float32)
+	if out is not None and out.dtype == work_type:
+		buf = out
+		np.copyto(buf, array, casting='unsafe')
+	else:
+		buf = np.array(array, dtype=work_type)
+	if ww <= 1:
+		# Degenerate window: lower and upper bound coincide, window_hu becomes a step function
+		np.greater(buf, wc - 0.5, out=buf)
+		buf *= _max
+	else:
+		buf -= (wc - 0.5)
+		buf /= (ww - 1)
+		buf += 0.5
+		buf *= ((_max - _min) + _min)
+		np.clip(buf, _min, _max, out=buf)
+	if buf.dtype == dtype:
+		return buf
+	if out is not None and out.dtype == dtype:
+		np.copyto(out, buf, casting='unsafe')
+		return out
+	return buf.astype(dtype)
 
 
 class Timer:
@@ -42,3 +69,47 @@ class Timer:
 		self._start_time = None
 		print(f"Elapsed time: {elapsed_time:0.4f} seconds")
 		return elapsed_time
+
+
+def overlay_lut(colors: dict, label_list=(1, 2, 3), alpha: float = 1.0) -> np.ndarray:
+	# RGBA lookup table (256 * 256, 4) uint8 for render_overlay, row label_id * 256 + grey value.
+	# Labels in label_list get their (r, g, b) color from colors (keys are str(label_id)) blended over the grey
+	# value by alpha, all other labels show the plain grey value. Fully opaque
+	grey = np.arange(256, dtype=np.float32)
+	lut = np.empty((256, 256, 4), dtype=np.uint8)
+	lut[:, :, :3] = grey[None, :, None]
+	lut[:, :, 3] = 255
+	for label_id in label_list:
+		color = np.asarray(colors[str(label_id)], dtype=np.float32)
+		lut[label_id & 0xFF, :, :3] = np.rint(grey[:, None] * (1 - alpha) + color * alpha)
+	return lut.reshape(-1, 4)
+
+
+def render_overlay(labels: np.ndarray, lut: np.ndarray, data: np.ndarray = None,
+                   out: np.ndarray = None) -> np.ndarray:
+	# Label IDs (H, W) and windowed uint8 grey data (H, W) to an (H, W, 4) RGBA image (Qt Format_RGBA8888 or RGBX8888) in one
+	# table lookup per pixel, see overlay_lut. Without data the background is white, without labels only the
+	# data is shown. "out" can be passed to reuse a contiguous (H, W, 4) uint8 buffer
+	if labels is None and data is None:
+		raise ValueError("Nothing to render")
+	shape = labels.shape if labels is not None else data.shape
+	if labels is not None:
+		key = labels.astype(np.uint16)
+		key &= 0xFF
+		key <<= 8
+	else:
+		key = np.zeros(shape, dtype=np.uint16)
+	if data is not None:
+		key |= data
+	else:
+		key |= 255
+	if out is None or out.shape != shape + (4,) or out.dtype != np.uint8 or not out.flags.c_contiguous:
+		out = np.empty(shape + (4,), dtype=np.uint8)
+	# RGBA pixels as single uint32 values, so the whole image is one take
+	np.take(lut.view(np.uint32).ravel(), key, out=out.view(np.uint32).reshape(shape), mode='clip')
+	return out
+
+
+def nearest_index(size: int, target_size: int) -> np.ndarray:
+	# Source index of each target pixel when scaling size pixels to target_size pixels (nearest neighbour)
+	return ((np.arange(target_size) + 0.5) * (size / target_size)).astype(np.intp)
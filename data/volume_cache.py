@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+'''
+On-disk cache of decoded series. The rescaled int16 (H, W, N) volume is stored as .npy next to a .json file
+with its metadata. Both are named by a hash of the folder path. The metadata holds a manifest of the source
+files (name, mtime, size) in loading order; if it no longer matches the folder the cache is stale and rebuilt.
+Cached volumes are opened memory-mapped (read only), so pages are only read from disk when accessed.
+'''
+
+
+def __cache_files(cache_dir: str, path: str):
+	key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+	return os.path.join(cache_dir, key + ".npy"), os.path.join(cache_dir, key + ".json")
+
+
+def build_manifest(file_paths: list) -> list:
+	# Identify each source file by name, modification time and size
+	manifest = []
+	for p in file_paths:
+		stat = os.stat(p)
+		manifest.append([os.path.basename(p), stat.st_mtime_ns, stat.st_size])
+	return manifest
+
+
+def load(cache_dir: str, path: str, file_paths: list):
+	# Returns (memory-mapped volume, metadata) or None if there is no valid cache for this folder
+	npy_path, meta_path = __cache_files(cache_dir, path)
+	if not os.path.isfile(npy_path) or not os.path.isfile(meta_path):
+		return None
+	try:
+		with open(meta_path, 'r') as f:
+			meta = json.load(f)
+		if meta['manifest'] != build_manifest(file_paths):
+			print("Volume cache of {} is stale".format(path))
+			return None
+		volume = np.load(npy_path, mmap_mode='r')
+		if list(volume.shape) != meta['dims'] + [len(file_paths)] or volume.dtype != np.int16:
+			print("Volume cache of {} does not match its metadata".format(path))
+			return None
+		return volume, meta
+	except (OSError, ValueError, KeyError) as e:
+		print(e)
+		print("Error reading volume cache of {}".format(path))
+		return None
+
+
+def store(cache_dir: str, path: str, file_paths: list, series) -> bool:
+	# Write the contiguous pixel volume of a fully loaded series. Metadata is written last, so an interrupted
+	# write never leaves a cache that looks valid
+	if series.pixel_volume is None:
+		return False
+	npy_path, meta_path = __cache_files(cache_dir, path)
+	meta = {
+		'path': os.path.abspath(path),
+		'manifest': build_manifest(file_paths),
+		'dims': list(series.pixel_volume.shape[:2]),
+		'dicom_format': [i.dicom_format for i in series.images],
+		'rescale': [__rescale(i.file_data) for i in series.images],
+	}
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		if os.path.isfile(meta_path):
+			os.remove(meta_path)
+		# The volume goes to a temporary file first: npy_path may still be mapped (e.g. by the series itself)
+		# and must not be truncated under its readers
+		tmp_npy = npy_path + ".tmp"
+		out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.int16, shape=series.pixel_volume.shape)
+		out[...] = series.pixel_volume
+		out.flush()
+		del out
+		os.replace(tmp_npy, npy_path)
+		tmp_path = meta_path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump(meta, f)
+		os.replace(tmp_path, meta_path)
+		return True
+	except OSError as e:
+		print(e)
+		print("Error writing volume cache of {}".format(path))
+		return False
+
+
+def __rescale(file_data):
+	# (slope, intercept) of a DICOM header, None if unknown (non DICOM or header not kept)
+	if file_data is None:
+		return None
+	try:
+		return [float(file_data[0x0028, 0x1053].value), float(file_data[0x0028, 0x1052].value)]
+	except Exception:
+		return [1.0, 0.0]
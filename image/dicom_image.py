@@ -3,6 +3,45 @@ import pydicom as dcm
 import os.path
 from data.image_label import ImageLabel
 from PIL import Image
+from typing import Tuple
+
+
+def read_file(path: str, keep_header: bool = True):
+	# Decode one image file to rescaled int16 pixels. Module level so it can run in a thread or process pool.
+	# Returns (pixels, dicom_format, file_data). Raises on unreadable files, callers decide how to report
+	file_name = os.path.basename(path)
+	file_data = None
+	if '.png' in file_name or '.jpg' in file_name:
+		dicom_format = False
+		image: Image = Image.open(path).convert('L')  # Load image and convert to greyscale
+		pixels = np.asarray(image)
+	else:
+		dicom_format = True
+		file_data = dcm.dcmread(path)
+		try:
+			rescaleIntercept = file_data[0x0028, 0x1052].value
+			rescaleSlope = file_data[0x0028, 0x1053].value
+		except Exception:
+			# In case exception is thrown, the values are not present. Likely non CT-image -> use standard
+			rescaleIntercept = 0
+			rescaleSlope = 1
+		raw = file_data.pixel_array
+		pixels = raw * rescaleSlope + rescaleIntercept
+		if not keep_header:
+			file_data = None  # Header holds the pixel bytes again, not worth sending back from a process
+	# print(f"File datatye {str(pixels.dtype)}")
+	return pixels.astype(np.int16), dicom_format, file_data
+
+
+def read_header(path: str) -> Tuple[tuple, bool]:
+	# Scan only the header of an image file. Returns (dims, dicom_format) without decoding any pixels
+	file_name = os.path.basename(path)
+	if '.png' in file_name or '.jpg' in file_name:
+		with Image.open(path) as image:
+			width, height = image.size
+		return (height, width), False
+	file_data = dcm.dcmread(path, stop_before_pixels=True)
+	return (int(file_data.Rows), int(file_data.Columns)), True
 
 
 class DicomImage:
@@ -10,27 +49,7 @@ class DicomImage:
 
 	def load_content(self):
 		try:
-			if '.png' in self.file_name or '.jpg' in self.file_name:
-				self.dicom_format = False
-				image: Image = Image.open(self.path).convert('L')  # Load image and convert to greyscale
-				self.pixels = np.asarray(image)
-			else:
-				self.dicom_format = True
-				file_data = dcm.dcmread(self.path)
-				try:
-					rescaleIntercept = file_data[0x0028, 0x1052].value
-					rescaleSlope = file_data[0x0028, 0x1053].value
-				except Exception:
-					# In case exception is thrown, the values are not present. Likely non CT-image -> use standard
-					rescaleIntercept = 0
-					rescaleSlope = 1
-				raw = file_data.pixel_array
-				self.pixels = raw * rescaleSlope + rescaleIntercept
-				self.file_data = file_data
-			# print(f"File datatye {str(self.pixels.dtype)}")
-			self.pixels = self.pixels.astype(np.int16)
-			self.loaded = True
-			self.label = ImageLabel(self.dims)
+			self.set_content(*read_file(self.path))
 		except FileNotFoundError:
 			print(f"File {self.path} does not exist")
 			self.loaded = False
@@ -39,12 +58,62 @@ class DicomImage:
 			print(f"Error loading image {self.path}")
 			self.loaded = False
 
+	def set_content(self, pixels: np.ndarray, dicom_format: bool, file_data: dcm.dataset.FileDataset = None):
+		# Take over decoded content, e.g. from read_file running in a worker
+		self.pixels = pixels
+		self.dicom_format = dicom_format
+		self.file_data = file_data
+		self.loaded = True
+		if self.label is None:
+			self.label = ImageLabel(self.dims)
+
+	def load_header(self, cache=None):
+		# Lazy mode: only read dimensions now, pixels get decoded on first access and are held by the cache.
+		# The label map is created right away, it is never dropped by the cache
+		try:
+			self.header_dims, self.dicom_format = read_header(self.path)
+			self.cache = cache
+			self.loaded = True
+			if self.label is None:
+				self.label = ImageLabel(self.header_dims)
+		except Exception as e:
+			print(e)
+			print(f"Error reading header of {self.path}")
+			self.loaded = False
+
+	def drop_pixels(self):
+		# Called by the cache on eviction. Lazy images decode again on next access
+		if self.cache is not None:
+			self.__pixels = None
+
+	@property
+	def pixels(self) -> np.ndarray:
+		if self.__pixels is None and self.cache is not None and self.loaded:
+			# Lazy image, decode on first access (or again after eviction)
+			pixels, _, _ = read_file(self.path, keep_header=False)
+			self.__pixels = pixels
+			self.cache.add(self, pixels.nbytes)
+		elif self.cache is not None and self.__pixels is not None:
+			self.cache.touch(self)
+		return self.__pixels
+
+	@pixels.setter
+	def pixels(self, value: np.ndarray):
+		self.__pixels = value
+
+	@property
+	def pixels_loaded(self) -> bool:
+		# True if pixel data is in memory right now, without triggering a lazy decode
+		return self.__pixels is not None
+
 	@property
 	def dims(self):
 		return self.__dims
 
 	@dims.getter
 	def dims(self):
+		if self.loaded and self.header_dims is not None:
+			return self.header_dims
 		if not self.loaded or self.pixels is None:
 			raise Exception("Image is not loaded - No dimensions avaible")
 		return np.shape(self.pixels)
@@ -57,6 +126,8 @@ class DicomImage:
 		self.file_name: str = tail
 		self.label: ImageLabel = None
 		self.file_data: dcm.dataset.FileDataset = None
-		self.pixels: np.ndarray = None
+		self.header_dims: tuple = None  # Set by load_header in lazy mode
+		self.cache = None               # SliceCache holding the pixels in lazy mode
+		self.__pixels: np.ndarray = None
 		self.loaded = False
 		self.dicom_format = True
@@ -12,77 +12,591 @@ Modified by Martin Sondermann using the base version from the scikit-image libra
 """
 import numpy as np
 from scipy import sparse, ndimage as ndi
-from pyamg import ruge_stuben_solver
+from pyamg import ruge_stuben_solver, smoothed_aggregation_solver
 from skimage import img_as_float
-from scipy.sparse.linalg import cg
-
-
-def _make_graph_edges_3d(n_x, n_y, n_z):
-	vertices = np.arange(n_x * n_y * n_z).reshape((n_x, n_y, n_z))
-	edges_deep = np.vstack((vertices[..., :-1].ravel(), vertices[..., 1:].ravel()))
-	edges_right = np.vstack((vertices[:, :-1].ravel(), vertices[:, 1:].ravel()))
-	edges_down = np.vstack((vertices[:-1].ravel(), vertices[1:].ravel()))
-	edges = np.hstack((edges_deep, edges_right, edges_down))
-	return edges
-
-
-def _compute_weights_3d(data, spacing, beta, eps):
-	gradients = np.concatenate(
-		[np.diff(data[..., 0], axis=ax).ravel() / spacing[ax] for ax in [2, 1, 0] if data.shape[ax] > 1], axis=0) ** 2
-	for channel in range(1, data.shape[-1]):
-		gradients += np.concatenate([np.diff(data[..., channel], axis=ax).ravel() / spacing[ax] for ax in [2, 1, 0] if data.shape[ax] > 1], axis=0) ** 2
-	scale_factor = -beta / (10 * data.std())
-	weights = np.exp(scale_factor * gradients)
-	weights += eps
-	#weights=weights.astype(np.float32) # Coversion did cause NaN's
-	return -weights
-
-
-def _build_laplacian(data, spacing, mask, beta):
-	l_x, l_y, l_z = data.shape[:3]
-	edges = _make_graph_edges_3d(l_x, l_y, l_z)
-	weights = _compute_weights_3d(data, spacing, beta=beta, eps=1.e-8)
-	# Build the sparse linear system
-	pixel_nb = edges.shape[1]
-	i_indices = edges.ravel()
-	j_indices = edges[::-1].ravel()
-	data = np.hstack((weights, weights))
-	lap = sparse.coo_matrix((data, (i_indices, j_indices)), shape=(pixel_nb, pixel_nb))
-	del data
-	lap.setdiag(-np.ravel(lap.sum(axis=0)))
-	return lap.tocsr()
-
-
-def _build_linear_system(data, spacing, labels, nlabels, mask, beta):
-	"""
-	Build the matrix A and rhs B of the linear system to solve.
-	A and B are two block of the laplacian of the image graph.
-	"""
-	if mask is None:
-		labels = labels.ravel()
-	else:
-		labels = labels[mask]
-	indices = np.arange(labels.size)
-	seeds_mask = labels > 0
-	unlabeled_indices = indices[~seeds_mask]
-	seeds_indices = indices[seeds_mask]
-	lap_sparse = _build_laplacian(data, spacing, mask=mask, beta=beta)
-	rows = lap_sparse[unlabeled_indices, :]
-	lap_sparse = rows[:, unlabeled_indices]
-	B = -rows[:, seeds_indices]
-	seeds = labels[seeds_mask]
-	seeds_mask = sparse.csc_matrix(np.hstack([np.atleast_2d(seeds == lab).T for lab in range(1, nlabels + 1)]))
-	rhs = B.dot(seeds_mask)
+from scipy.sparse.linalg import cg, splu, LinearOperator
+from pyamg.multilevel import MultilevelSolver
+from pyamg.relaxation.smoothing import change_smoothers
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+import hashlib
+import inspect
+import uuid
+
+
+def _compute_weights_3d(data, spacing, beta, eps, std=None):
+	"""
+	Edge weights of the 6-neighbour grid graph, one array per axis. weights[ax] has the shape of the grid
+	padded back to full size, weights[ax][x, y, z] is the edge between a node and its successor along ax.
+	The last plane along ax holds 0 (no edge). Weights of existing edges are always > 0.
+	Works in the dtype of data. For reduced precision the exponent is clamped above the underflow limit and
+	the weights get an epsilon floor of the dtype resolution, so no edge weight becomes 0, inf or NaN.
+	std: standard deviation the beta scaling is based on, if data is part of a bigger volume (slabs)
+	"""
+	dtype = data.dtype
+	if std is None:
+		std = float(data.std())
+	scale_factor = -beta / (10 * std) if std > 0 else 0.0  # Constant image: all weights 1 instead of NaN
+	weights = []
+	for ax in range(3):
+		w = np.zeros(data.shape[:3], dtype=dtype)
+		if data.shape[ax] > 1:
+			inner = w[tuple(slice(0, -1) if a == ax else slice(None) for a in range(3))]
+			for channel in range(data.shape[-1]):
+				inner += (np.diff(data[..., channel], axis=ax) / spacing[ax]) ** 2
+			inner *= dtype.type(scale_factor)
+			np.maximum(inner, np.log(np.finfo(dtype).tiny), out=inner)
+			np.exp(inner, out=inner)
+			inner += max(eps, np.finfo(dtype).eps)
+			if not np.all(np.isfinite(inner)):
+				raise ValueError("Edge weights are not finite, check data for NaN/inf values")
+		weights.append(w)
+	return weights
+
+
+def _build_linear_system(weights, labels, nlabels, prob=None):
+	"""
+	Build the matrix A and rhs B of the linear system to solve, directly from the grid structure.
+	A is the unknown-by-unknown block of the graph Laplacian as CSR matrix, B (unknowns x nlabels, dense)
+	the coupling of the unknowns to the seeds of each label. Nodes with labels < 0 are pruned from the graph.
+	prob: optional fixed probabilities (nlabels x nodes) of the seeded nodes, for boundary conditions that are
+	not a single label. Without it a seed has probability 1 for its own label.
+	No full Laplacian is assembled: each unknown row gets its up to 6 neighbours and the diagonal written
+	in ascending column order, so the CSR arrays are filled in one pass per direction without sorting.
+	Indices are int32 as long as the number of non-zeros (at most 7 per node) allows.
+	"""
+	shape = labels.shape
+	labels = labels.ravel()
+	dtype = weights[0].dtype
+	n_nodes = labels.size
+	strides = (shape[1] * shape[2], shape[2], 1)
+	# indptr counts up to 7 entries per row, neighbour indices reach past the last node by a stride
+	index_type = np.int32 if max(7 * n_nodes, n_nodes + strides[0]) < np.iinfo(np.int32).max else np.int64
+	unknown = np.flatnonzero(labels == 0).astype(index_type)
+	n_unknown = unknown.size
+	reduced = np.full(n_nodes, -1, dtype=index_type)  # Node index -> row in A, -1 for seeds and pruned nodes
+	reduced[unknown] = np.arange(n_unknown, dtype=index_type)
+
+	def neighbours(ax, sign):
+		# Weight and node index of the neighbour of each unknown along ax in direction sign. 0 weight: no edge
+		if sign > 0:
+			w = weights[ax].ravel()[unknown]
+			neighbour = np.minimum(unknown + strides[ax], n_nodes - 1)
+		else:
+			neighbour = unknown - strides[ax]
+			has_edge = (unknown // strides[ax]) % shape[ax] > 0
+			w = np.where(has_edge, weights[ax].ravel()[np.maximum(neighbour, 0)], 0).astype(dtype, copy=False)
+			neighbour = np.maximum(neighbour, 0)
+		w[labels[neighbour] < 0] = 0  # Edges into pruned zones are removed
+		return w, neighbour
+
+	# Column order within a row: -axis 0, -axis 1, -axis 2, diagonal, +axis 2, +axis 1, +axis 0
+	directions = [(0, -1), (1, -1), (2, -1), None, (2, 1), (1, 1), (0, 1)]
+	counts = np.ones(n_unknown, dtype=index_type)
+	diagonal = np.zeros(n_unknown, dtype=dtype)
+	rhs = np.zeros((n_unknown, nlabels), dtype=dtype)
+	for direction in directions:
+		if direction is None:
+			continue
+		w, neighbour = neighbours(*direction)
+		diagonal += w
+		neighbour_label = labels[neighbour]
+		counts += (w > 0) & (neighbour_label == 0)
+		seeded = np.flatnonzero((w > 0) & (neighbour_label > 0))
+		if prob is None:
+			rhs[seeded, neighbour_label[seeded] - 1] += w[seeded]
+		else:
+			rhs[seeded] += w[seeded, np.newaxis] * prob[:, neighbour[seeded]].T
+	indptr = np.zeros(n_unknown + 1, dtype=index_type)
+	np.cumsum(counts, out=indptr[1:])
+	del counts
+	indices = np.empty(indptr[-1], dtype=index_type)
+	values = np.empty(indptr[-1], dtype=dtype)
+	position = indptr[:-1].copy()
+	for direction in directions:
+		if direction is None:
+			indices[position] = np.arange(n_unknown, dtype=index_type)
+			values[position] = diagonal
+			position += 1
+			continue
+		w, neighbour = neighbours(*direction)
+		rows = np.flatnonzero((w > 0) & (labels[neighbour] == 0))
+		indices[position[rows]] = reduced[neighbour[rows]]
+		values[position[rows]] = -w[rows]
+		position[rows] += 1
+	lap_sparse = sparse.csr_matrix((values, indices, indptr), shape=(n_unknown, n_unknown))
+	lap_sparse.has_sorted_indices = True
 	return lap_sparse, rhs
 
 
-def _solve_linear_system(lap_sparse, B, tol):
-	lap_sparse = lap_sparse.tocsr()
-	ml = ruge_stuben_solver(lap_sparse)
-	M = ml.aspreconditioner(cycle='V')
-	cg_out = [cg(lap_sparse, B[:, i].toarray(), tol=tol, M=M, maxiter=30) for i in range(B.shape[1])]
-	X = np.asarray([x for x, _ in cg_out])
-	return X
+class _StencilLaplacian(LinearOperator):
+	"""
+	Matrix-free unknown-by-unknown block of the grid Laplacian. Only the per-axis weights of
+	_compute_weights_3d and the node degrees are stored, a product is evaluated as 6-neighbour stencil on
+	the grid: unknowns are scattered into a full size vector (seeds and pruned nodes stay 0), the stencil is
+	applied and the unknowns are gathered again. Memory is a few grid sized vectors instead of a CSR matrix.
+	Products may run concurrently (label columns solved by threads), every thread scatters into its own vector.
+	"""
+
+	def __init__(self, weights, labels):
+		self.weights = weights
+		self.grid_shape = labels.shape
+		flat_labels = labels.ravel()
+		self.unknown = np.flatnonzero(flat_labels == 0)
+		dtype = weights[0].dtype
+		pruned = labels < 0
+		degree = np.zeros(self.grid_shape, dtype=dtype)
+		for ax, w in enumerate(weights):
+			lower, upper = self.__halves(ax)
+			edge = w[lower]
+			if np.any(pruned):
+				edge = np.where(pruned[lower] | pruned[upper], 0, edge)  # Edges into pruned zones are removed
+			degree[lower] += edge
+			degree[upper] += edge
+		self.degree = degree.ravel()[self.unknown]
+		self.local = threading.local()  # Per thread scatter vector of _matvec
+		super().__init__(dtype=dtype, shape=(self.unknown.size, self.unknown.size))
+
+	def __halves(self, ax):
+		# Index of all nodes with a successor along ax and of their successors
+		lower = tuple(slice(0, -1) if a == ax else slice(None) for a in range(3))
+		upper = tuple(slice(1, None) if a == ax else slice(None) for a in range(3))
+		return lower, upper
+
+	def neighbour_sum(self, full):
+		# sum_j w_ij * full_j for every node of the grid (off-diagonal part of the Laplacian, sign flipped)
+		full = full.reshape(self.grid_shape)
+		out = np.zeros(self.grid_shape, dtype=self.dtype)
+		for ax, w in enumerate(self.weights):
+			lower, upper = self.__halves(ax)
+			out[lower] += w[lower] * full[upper]
+			out[upper] += w[lower] * full[lower]
+		return out.ravel()
+
+	def rhs(self, labels, nlabels, prob=None):
+		# Coupling of the unknowns to the seeds of each label, same as B of _build_linear_system
+		flat_labels = labels.ravel()
+		B = np.empty((self.unknown.size, nlabels), dtype=self.dtype)
+		for lab in range(1, nlabels + 1):
+			if prob is None:
+				seeds = (flat_labels == lab).astype(self.dtype)
+			else:
+				seeds = np.where(flat_labels > 0, prob[lab - 1], 0).astype(self.dtype, copy=False)
+			B[:, lab - 1] = self.neighbour_sum(seeds)[self.unknown]
+		return B
+
+	def diagonal(self):
+		return self.degree
+
+	def _matvec(self, x):
+		x = x.ravel()
+		buffer = getattr(self.local, 'buffer', None)
+		if buffer is None:
+			# Only the unknowns are ever written, seeds and pruned nodes stay 0
+			buffer = self.local.buffer = np.zeros(int(np.prod(self.grid_shape)), dtype=self.dtype)
+		buffer[self.unknown] = x
+		return self.degree * x - self.neighbour_sum(buffer)[self.unknown]
+
+	def _rmatvec(self, x):
+		return self._matvec(x)  # Symmetric
+
+
+class SolverCache:
+	"""
+	LRU cache of solver setup between random_walker runs on the same data, bounded by budget bytes.
+	An entry is keyed by data fingerprint, shape, beta and an optional caller key (e.g. the slice range).
+	It holds the edge weights of the graph (all the Laplacian is built from) and the last solver setup (AMG
+	hierarchy, LU factorization) together with the mode and seed layout it was built for. Changing seeds
+	skips the weight computation, an unchanged seed layout (re-run, seeds swapped between labels)
+	additionally skips the solver setup.
+	With incremental runs the entry also keeps the last probability field (nlabels x N in the solver dtype) as start
+	value of the next solve. It counts against the budget and is dropped before the rest of its entry.
+	An AMG hierarchy is reused through _PatchedPreconditioner as long as at most patch_limit of the unknowns
+	changed between seed and unknown since it was built.
+	Least recently used entries are dropped as soon as the entries together exceed the budget, an entry larger
+	than the budget on its own is not kept at all.
+	"""
+
+	def __init__(self, budget=512 * 2 ** 20, patch_limit=0.05):
+		self.budget = budget
+		self.patch_limit = patch_limit
+		self.entries = OrderedDict()
+		self.sizes = {}  # Bytes of each entry, as counted on put
+		self.stats = {'weights_hits': 0, 'weights_misses': 0, 'setup_hits': 0, 'setup_misses': 0,
+		              'setup_patched': 0, 'evictions': 0}
+
+	@staticmethod
+	def fingerprint(data):
+		return hashlib.blake2b(np.ascontiguousarray(data).data, digest_size=16).hexdigest()
+
+	@property
+	def nbytes(self):
+		return sum(self.sizes.values())
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is not None:
+			self.entries.move_to_end(key)
+		return entry
+
+	def put(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		self.sizes[key] = _nbytes(entry)
+		while self.nbytes > self.budget:
+			old_key, old_entry = next(iter(self.entries.items()))
+			if old_entry.get('prob') is not None:
+				# The warm start is cheapest to lose, the setup of the entry stays
+				old_entry['prob'] = None
+				old_entry['label_values'] = None
+				self.sizes[old_key] = _nbytes(old_entry)
+				continue
+			del self.entries[old_key]
+			del self.sizes[old_key]
+			self.stats['evictions'] += 1
+
+	def clear(self):
+		self.entries.clear()
+		self.sizes.clear()
+
+	def __str__(self):
+		return "SolverCache: {} entries, {:.1f} MB, graph weights {}/{} hit/miss, solver setup {}/{}/{} " \
+		       "hit/patched/miss".format(len(self.entries), self.nbytes / 2 ** 20, self.stats['weights_hits'],
+		                                 self.stats['weights_misses'], self.stats['setup_hits'],
+		                                 self.stats['setup_patched'], self.stats['setup_misses'])
+
+
+def _nbytes(obj):
+	# Approximate resident bytes of cached arrays, sparse matrices and solver setups
+	if obj is None:
+		return 0
+	if isinstance(obj, np.ndarray):
+		return obj.nbytes
+	if sparse.issparse(obj):
+		return sum(getattr(obj, name).nbytes for name in ('data', 'indices', 'indptr', 'row', 'col', 'offsets')
+		           if isinstance(getattr(obj, name, None), np.ndarray))
+	if isinstance(obj, dict):
+		return sum(_nbytes(v) for v in obj.values())
+	if isinstance(obj, (list, tuple)):
+		return sum(_nbytes(v) for v in obj)
+	if isinstance(obj, MultilevelSolver):
+		return sum(_nbytes(v) for level in obj.levels for v in vars(level).values())
+	if hasattr(obj, 'perm_c') and hasattr(obj, 'nnz'):
+		# SuperLU factorization: values and row indices of L and U plus the permutations
+		return obj.nnz * 12 + obj.perm_c.nbytes + obj.perm_r.nbytes
+	return 0
+
+
+class _PatchedPreconditioner(LinearOperator):
+	"""
+	Preconditioner of a reduced Laplacian built from the one of an earlier seed layout. Unknowns of both
+	layouts are mapped onto the old unknown order and go through the old preconditioner, nodes that were
+	seeds before (erased seeds) get a Jacobi step. Restriction and prolongation are the same injection, so
+	the operator stays symmetric positive definite as CG requires.
+	base_unknown, unknown: flat boolean masks of the unknown nodes of the old and the new layout
+	"""
+
+	def __init__(self, base_M, base_unknown, unknown, diag):
+		self.base_M = base_M
+		self.base_size = int(np.count_nonzero(base_unknown))
+		base_index = np.cumsum(base_unknown) - 1
+		nodes = np.flatnonzero(unknown)
+		self.shared = base_unknown[nodes]
+		self.base_pos = base_index[nodes[self.shared]]
+		self.diag = diag
+		super().__init__(dtype=diag.dtype, shape=(nodes.size, nodes.size))
+
+	def _matvec(self, x):
+		x = x.ravel()
+		r = np.zeros(self.base_size, dtype=x.dtype)
+		r[self.base_pos] = x[self.shared]
+		z = x / self.diag
+		z[self.shared] = self.base_M.matvec(r)[self.base_pos]
+		return z
+
+
+def _block_cg(A, B, M, tol, maxiter, X0=None, callback=None):
+	"""
+	Preconditioned conjugate gradient on all columns of B at once. Each column keeps its own step sizes,
+	but the mat-vecs are done as one sparse mat-mat product per iteration and all columns share the
+	preconditioner. Converged columns are frozen. Returns X with one column per right hand side, the
+	iteration count of each column and whether it met the tolerance. X0 is an optional start value (warm
+	start), callback is called with the iteration number after each iteration.
+	"""
+	if X0 is None:
+		X = np.zeros(B.shape, dtype=np.result_type(A.dtype, B.dtype))
+		R = B.copy()
+	else:
+		X = np.array(X0, dtype=np.result_type(A.dtype, B.dtype))
+		R = B - A @ X
+	b_norm = np.linalg.norm(B, axis=0)
+	b_norm[b_norm == 0] = 1
+	active = np.linalg.norm(R, axis=0) > tol * b_norm
+	Z = M.matmat(R)
+	P = Z.copy()
+	rz = np.einsum('ij,ij->j', R, Z)
+	iterations = np.zeros(B.shape[1], dtype=int)
+	for _ in range(maxiter):
+		if not np.any(active):
+			break
+		cols = np.flatnonzero(active)
+		iterations[cols] += 1
+		AP = A @ P[:, cols]
+		alpha = rz[cols] / np.einsum('ij,ij->j', P[:, cols], AP)
+		X[:, cols] += P[:, cols] * alpha
+		R[:, cols] -= AP * alpha
+		active[cols] = np.linalg.norm(R[:, cols], axis=0) > tol * b_norm[cols]
+		cols = np.flatnonzero(active)
+		if cols.size == 0:
+			break
+		Z = M.matmat(R[:, cols])
+		rz_new = np.einsum('ij,ij->j', R[:, cols], Z)
+		P[:, cols] = Z + P[:, cols] * (rz_new / rz[cols])
+		rz[cols] = rz_new
+		if callback is not None:
+			callback(int(iterations.max()))
+	return X, list(iterations), [not a for a in active]
+
+
+SOLVER_MODES = ('cg_amg', 'cg_j', 'multigrid', 'direct', 'matrix_free')
+
+
+def _report(progress, stage, step=0, total=0):
+	# Forward a stage to an optional progress callback. The callback may raise to cancel the run
+	if progress is not None:
+		progress(stage, step, total)
+
+
+def _select_mode(n_unknown, depth, itemsize, memory_budget):
+	"""
+	Policy for mode='auto'. Memory estimates are rough, based on the size of the assembled matrix (7 entries
+	per row): a sparse LU of a 2D grid Laplacian fills in to about 25x the matrix, an AMG hierarchy about 3x.
+	- single slices whose factorization fits the budget are solved directly
+	- otherwise AMG preconditioned CG, smoothed aggregation for big systems as its setup is cheaper there
+	- if not even the AMG hierarchy fits, Jacobi preconditioned CG
+	- if not even the matrix fits, matrix-free Jacobi preconditioned CG
+	"""
+	matrix_bytes = 7 * n_unknown * (itemsize + 4) + n_unknown * 8
+	if depth == 1 and n_unknown <= 600000 and 25 * matrix_bytes <= memory_budget:
+		return 'direct'
+	if 3 * matrix_bytes <= memory_budget:
+		return 'multigrid' if n_unknown > 2000000 else 'cg_amg'
+	if matrix_bytes <= memory_budget:
+		return 'cg_j'
+	return 'matrix_free'
+
+
+def _setup_solver(lap_sparse, mode):
+	# Build what a mode needs before solving: AMG hierarchy, Jacobi diagonal or LU factorization
+	if mode == 'cg_amg':
+		return ruge_stuben_solver(lap_sparse)
+	if mode == 'multigrid':
+		return smoothed_aggregation_solver(lap_sparse)
+	if mode in ('cg_j', 'matrix_free'):
+		diag = lap_sparse.diagonal()
+		return LinearOperator(lap_sparse.shape, matvec=lambda x: x.ravel() / diag,
+		                      matmat=lambda x: x / diag[:, np.newaxis], dtype=lap_sparse.dtype)
+	if mode == 'direct':
+		return splu(lap_sparse.tocsc(), permc_spec='COLAMD')
+	raise ValueError("Unknown solver mode '{}', use one of {} or 'auto'".format(mode, SOLVER_MODES))
+
+
+# Smoothers the hierarchies of _setup_solver are built with (pyamg defaults), to rebuild them in other processes
+_AMG_SMOOTHERS = {mode: tuple(inspect.signature(solver).parameters[p].default for p in ('presmoother', 'postsmoother'))
+                  for mode, solver in (('cg_amg', ruge_stuben_solver), ('multigrid', smoothed_aggregation_solver))}
+_attached = dict()  # Per worker process: shared system attached last, see _attach_shared
+
+
+def _share_arrays(arrays):
+	# Copy arrays into new shared memory blocks. Returns the blocks by name and a picklable spec to attach them
+	blocks = dict()
+	spec = dict()
+	for name, array in arrays.items():
+		block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+		np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+		blocks[name] = block
+		spec[name] = (block.name, array.shape, array.dtype.str)
+	return blocks, spec
+
+
+def _attach_shared(spec):
+	"""
+	Worker side of _solve_columns_shared: map the shared arrays of spec without copying and build matrix and
+	preconditioner on top of them. The AMG hierarchy is put together from the shared level matrices, only the
+	smoother set up is redone. Kept for all labels the process solves.
+	"""
+	if _attached.get('id') == spec['id']:
+		return _attached
+	for block in _attached.get('blocks', []):
+		block.close()
+	_attached.clear()
+	blocks = []
+	arrays = dict()
+	for name, (block_name, shape, dtype) in spec['arrays'].items():
+		block = shared_memory.SharedMemory(name=block_name)  # Pool workers share the parent's resource tracker
+		blocks.append(block)
+		arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+	def csr(name):
+		return sparse.csr_matrix((arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr']),
+		                         shape=spec['shapes'][name], copy=False)
+
+	lap_sparse = csr('A0')
+	if spec['mode'] == 'cg_j':
+		diag = lap_sparse.diagonal()
+		M = LinearOperator(lap_sparse.shape, matvec=lambda x: x.ravel() / diag, dtype=lap_sparse.dtype)
+	else:
+		levels = []
+		for lvl in range(spec['levels']):
+			level = MultilevelSolver.Level()
+			level.A = csr('A{}'.format(lvl))
+			if lvl < spec['levels'] - 1:
+				level.P = csr('P{}'.format(lvl))
+				level.R = csr('R{}'.format(lvl))
+			levels.append(level)
+		ml = MultilevelSolver(levels)
+		change_smoothers(ml, *_AMG_SMOOTHERS[spec['mode']])
+		M = ml.aspreconditioner(cycle='V')
+	_attached.update(id=spec['id'], blocks=blocks, A=lap_sparse, M=M, B=arrays['B'], X=arrays['X'])
+	return _attached
+
+
+def _solve_shared_column(spec, i, tol, maxiter):
+	# Solve label i of a shared system in a worker process, the solution is written to the shared X
+	system = _attach_shared(spec)
+	count = [0]
+	system['X'][i], cg_info = cg(system['A'], system['B'][i], x0=system['X'][i], tol=tol, M=system['M'],
+	                             maxiter=maxiter, callback=lambda xk: count.__setitem__(0, count[0] + 1))
+	return count[0], cg_info == 0
+
+
+def _solve_columns_shared(lap_sparse, B, setup, mode, tol, maxiter, X0, workers, progress=None):
+	"""
+	Solve the columns of B in a process pool. Matrix, rhs, start/solution vectors and the matrices of all AMG
+	levels are copied once into shared memory, the workers map them instead of receiving pickled copies.
+	Returns X (unknowns x columns), iterations and convergence flags.
+	"""
+	n_solve = B.shape[1]
+	arrays = {'B': np.ascontiguousarray(B.T, dtype=lap_sparse.dtype),
+	          'X': np.zeros((n_solve, lap_sparse.shape[0]), dtype=lap_sparse.dtype) if X0 is None else
+	          np.ascontiguousarray(X0.T, dtype=lap_sparse.dtype)}
+	shapes = dict()
+	matrices = {'A0': lap_sparse}
+	if mode != 'cg_j':
+		for lvl, level in enumerate(setup.levels):
+			matrices['A{}'.format(lvl)] = level.A
+			if lvl < len(setup.levels) - 1:
+				matrices['P{}'.format(lvl)] = level.P
+				matrices['R{}'.format(lvl)] = level.R
+	for name, matrix in matrices.items():
+		matrix = matrix.tocsr()
+		arrays.update({name + '_data': matrix.data, name + '_indices': matrix.indices, name + '_indptr': matrix.indptr})
+		shapes[name] = matrix.shape
+	blocks, spec = _share_arrays(arrays)
+	try:
+		spec = {'id': uuid.uuid4().hex, 'mode': mode, 'levels': len(setup.levels) if mode != 'cg_j' else 1,
+		        'shapes': shapes, 'arrays': spec}
+		results = [None] * n_solve
+		# Spawned, not forked: the solve may run in the GUI process with Qt and worker threads running
+		with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+			futures = [pool.submit(_solve_shared_column, spec, i, tol, maxiter) for i in range(n_solve)]
+			try:
+				for i, future in enumerate(futures):
+					results[i] = future.result()
+					_report(progress, "CG labels", i + 1, n_solve)
+			except BaseException:
+				for future in futures:
+					future.cancel()  # Labels not started yet, running ones are waited for
+				raise
+		X = np.array(np.ndarray((n_solve, lap_sparse.shape[0]), dtype=lap_sparse.dtype, buffer=blocks['X'].buf).T)
+	finally:
+		for block in blocks.values():
+			block.close()
+			block.unlink()
+	return X, [r[0] for r in results], [r[1] for r in results]
+
+
+def _solve_linear_system(lap_sparse, B, tol, mode='cg_amg', setup=None, block=False, maxiter=30, X0=None,
+                         progress=None, workers=1, executor='thread'):
+	"""
+	Solve lap_sparse X = B with one of SOLVER_MODES.
+	setup: result of _setup_solver from an earlier run on the same matrix or a preconditioner (LinearOperator) of
+	the CG based modes, built here if None.
+	block: solve all right hand sides together with _block_cg. As the probabilities of all labels sum up to
+	one in every pixel, only nlabels - 1 systems are solved and the last label is the remainder
+	X0: start value of the CG based modes (unknowns x nlabels), e.g. a previous or coarser solution
+	progress: optional callback progress(stage, step, total), called before the setup and after every CG iteration
+	workers: solve the labels of the CG based modes in parallel (not with block). executor 'thread' shares all
+	objects directly, 'process' puts matrix, rhs, solution and AMG hierarchy into shared memory, see
+	_solve_columns_shared. Progress is reported per finished label then
+	Returns X (nlabels x unknowns), the setup and a dict with diagnostics (iterations, relative residuals,
+	convergence flags, setup/solve time in seconds)
+	"""
+	if sparse.issparse(lap_sparse):
+		lap_sparse = lap_sparse.tocsr()
+	info = {'mode': mode, 'unknowns': lap_sparse.shape[0], 'setup_time': 0.0}
+	if setup is None:
+		_report(progress, "Solver setup ({})".format(mode))
+		t_start = time.perf_counter()
+		setup = _setup_solver(lap_sparse, mode)
+		info['setup_time'] = time.perf_counter() - t_start
+	t_start = time.perf_counter()
+	B = B.toarray() if sparse.issparse(B) else np.asarray(B)
+	n_solve = B.shape[1] - 1 if block else B.shape[1]
+	if mode == 'direct':
+		_report(progress, "Solving (direct)")
+		X = setup.solve(np.asarray(B[:, :n_solve], dtype=lap_sparse.dtype))
+		iterations = [1] * n_solve
+		converged = [True] * n_solve
+	else:
+		M = setup if isinstance(setup, LinearOperator) else setup.aspreconditioner(cycle='V')
+		if block:
+			X, iterations, converged = _block_cg(lap_sparse, B[:, :n_solve], M, tol=tol, maxiter=maxiter,
+			                                     X0=None if X0 is None else X0[:, :n_solve],
+			                                     callback=lambda it: _report(progress, "CG all labels", it, maxiter))
+		elif workers > 1 and executor == 'process' and sparse.issparse(lap_sparse) and \
+				(mode == 'cg_j' or isinstance(setup, MultilevelSolver)):
+			X, iterations, converged = _solve_columns_shared(lap_sparse, B[:, :n_solve], setup, mode, tol, maxiter,
+			                                                 X0, workers, progress)
+		else:
+			X = np.empty((lap_sparse.shape[0], n_solve), dtype=lap_sparse.dtype)
+
+			def solve_column(i):
+				count = [0]
+
+				def iteration(xk):
+					count[0] += 1
+					if workers == 1:
+						_report(progress, "CG label {}/{}".format(i + 1, n_solve), count[0], maxiter)
+
+				X[:, i], cg_info = cg(lap_sparse, B[:, i], x0=None if X0 is None else X0[:, i], tol=tol, M=M, maxiter=maxiter,
+				                      callback=iteration)
+				if workers > 1:
+					_report(progress, "CG labels", i + 1, n_solve)
+				return count[0], cg_info == 0
+
+			if workers > 1:
+				# Threads only help as far as the sparse and smoother kernels release the GIL
+				with ThreadPoolExecutor(max_workers=workers) as pool:
+					results = list(pool.map(solve_column, range(n_solve)))
+			else:
+				results = [solve_column(i) for i in range(n_solve)]
+			iterations = [r[0] for r in results]
+			converged = [r[1] for r in results]
+	b_norm = np.linalg.norm(B[:, :n_solve], axis=0)
+	b_norm[b_norm == 0] = 1
+	info['residuals'] = [float(r) for r in np.linalg.norm(B[:, :n_solve] - lap_sparse @ X, axis=0) / b_norm]
+	info['iterations'] = [int(it) for it in iterations]
+	info['converged'] = [bool(c) for c in converged]
+	X = X.T
+	if block:
+		X = np.vstack((X, 1 - X.sum(axis=0)))
+	info['solve_time'] = time.perf_counter() - t_start
+	return X, setup, info
 
 
 def _preprocess(labels):
@@ -102,7 +616,7 @@ def _preprocess(labels):
 			np.logical_not(ndi.binary_propagation(pos_mask, mask=mask)), null_mask)
 		labels[isolated] = -1
 		if np.all(isolated[null_mask]):
-			return labels, None, None, None, None
+			return labels, None, None, None, None, None
 		mask[isolated] = False
 		mask = np.atleast_3d(mask)
 	else:
@@ -113,34 +627,314 @@ def _preprocess(labels):
 	nlabels = label_values[zero_idx + 1:].shape[0]
 	inds_isolated_seeds = np.nonzero(isolated)
 	isolated_values = labels[inds_isolated_seeds]
-	return labels, nlabels, mask, inds_isolated_seeds, isolated_values
+	return labels, nlabels, mask, inds_isolated_seeds, isolated_values, label_values[zero_idx + 1:]
 
 
-def random_walker(data, labels, beta=130, tol=1.e-3, copy=False):
+def random_walker(data, labels, beta=130, tol=1.e-3, copy=False, cache=None, cache_key=None, block=False,
+                  mode='cg_amg', maxiter=30, memory_budget=2 * 2 ** 30, dtype=np.float64, return_info=False,
+                  return_full_prob=False, x0=None, incremental=False, progress=None, workers=1, executor='thread'):
+	"""
+	cache: optional SolverCache to reuse the Laplacian and solver setup between runs on the same data.
+	cache_key: additional hashable part of the cache key, e.g. the segmented slice range
+	block: solve all labels together with a block CG (nlabels - 1 systems), see _solve_linear_system
+	mode: solver backend, one of SOLVER_MODES or 'auto' to pick one by unknown count and memory_budget (bytes)
+	'cg_amg'    CG with Ruge-Stuben AMG preconditioner (default)
+	'cg_j'      CG with Jacobi preconditioner, no setup and least memory
+	'multigrid' CG with smoothed aggregation AMG preconditioner, cheaper setup on big stacks
+	'direct'    sparse LU factorization, fastest on single slices
+	'matrix_free' Jacobi preconditioned CG on a stencil operator, no matrix is assembled (_StencilLaplacian)
+	maxiter: iteration limit of the CG based modes
+	dtype: floating point type of weights, Laplacian and solver vectors. np.float32 halves their memory
+	return_info: additionally return a dict with diagnostics of the solve (see _solve_linear_system)
+	return_full_prob: return the probabilities (nlabels, *labels.shape) instead of the label image. Index i
+	belongs to the i-th smallest positive label value, seeds have probability 1 for their own label
+	x0: start probabilities of the same layout as return_full_prob (warm start of the CG based modes)
+	incremental: for re-runs after seed edits, keep the probabilities in the cache entry and start the next
+	solve from them; the AMG hierarchy of the CG modes is patched instead of rebuilt for small edits
+	progress: optional callback progress(stage, step, total) for the stages edge weights, graph, solver setup and
+	the CG iterations of each label. An exception raised by it cancels the run
+	workers, executor: solve the labels in parallel with threads or processes, see _solve_linear_system
+	"""
+	if mode != 'auto' and mode not in SOLVER_MODES:
+		raise ValueError("Unknown solver mode '{}', use one of {} or 'auto'".format(mode, SOLVER_MODES))
 	spacing = np.ones(3)
 	if data.ndim not in (2, 3):
 		raise ValueError('For non-multichannel input, data must be of dimension 2 or 3.')
 	if data.shape != labels.shape:
 		raise ValueError('Incompatible data and labels shapes.')
-	data = np.atleast_3d(img_as_float(data))[..., np.newaxis]
+	dtype = np.dtype(dtype)
+	if dtype not in (np.float32, np.float64):
+		raise ValueError('dtype must be float32 or float64.')
+	data = np.atleast_3d(img_as_float(data).astype(dtype, copy=False))[..., np.newaxis]
 	labels_shape = labels.shape
 	labels_dtype = labels.dtype
 	if copy:
 		labels = np.copy(labels)
-	(labels, nlabels, mask, inds_isolated_seeds, isolated_values) = _preprocess(labels)
+	(labels, nlabels, mask, inds_isolated_seeds, isolated_values, label_values) = _preprocess(labels)
+	entry = None
+	if cache is not None:
+		key = (SolverCache.fingerprint(data), data.shape, data.dtype.str, beta, cache_key)
+		entry = cache.get(key)
+		if entry is None or mask is not None:
+			entry = {'weights': None, 'setup': None, 'seed_layout': None, 'base_unknown': None, 'prob': None,
+			         'label_values': None}
+			cache.stats['weights_misses'] += 1
+		else:
+			cache.stats['weights_hits'] += 1
+	if entry is not None and entry['weights'] is not None:
+		weights = entry['weights']
+	else:
+		_report(progress, "Edge weights")
+		weights = _compute_weights_3d(data, spacing, beta=beta, eps=1.e-8)
+		if entry is not None:
+			entry['weights'] = weights
+	if mode == 'auto':
+		mode = _select_mode(int(np.count_nonzero(labels == 0)), data.shape[2], dtype.itemsize, memory_budget)
 	# Build the linear system (lap_sparse, B)
-	lap_sparse, B = _build_linear_system(data, spacing, labels, nlabels, mask, beta)
+	_report(progress, "Graph")
+	if mode == 'matrix_free':
+		lap_sparse = _StencilLaplacian(weights, labels)
+		B = lap_sparse.rhs(labels, nlabels)
+	else:
+		lap_sparse, B = _build_linear_system(weights, labels, nlabels)
 
 	# Solve the linear system lap_sparse X = B
 	# where X[i, j] is the probability that a marker of label i arrives
 	# first at pixel j by anisotropic diffusion.
-	X = _solve_linear_system(lap_sparse, B, tol)
+	setup = None
+	patched = False
+	unknown = (labels == 0).ravel()
+	if entry is not None:
+		seed_layout = hashlib.blake2b(np.packbits(labels > 0).data, digest_size=16).hexdigest()
+		if entry['seed_layout'] == (mode, seed_layout):
+			setup = entry['setup']
+			cache.stats['setup_hits'] += 1
+		elif incremental and mode in ('cg_amg', 'multigrid') and entry['seed_layout'] is not None and \
+				entry['seed_layout'][0] == mode and entry['base_unknown'] is not None and \
+				np.count_nonzero(entry['base_unknown'] != unknown) <= cache.patch_limit * lap_sparse.shape[0]:
+			# Few nodes changed between seed and unknown: precondition with the hierarchy of the old layout
+			setup = _PatchedPreconditioner(entry['setup'].aspreconditioner(cycle='V'), entry['base_unknown'],
+			                               unknown, lap_sparse.diagonal())
+			patched = True
+			cache.stats['setup_patched'] += 1
+		else:
+			cache.stats['setup_misses'] += 1
+	X0 = None
+	if x0 is None and incremental and entry is not None and entry['prob'] is not None and \
+			np.array_equal(entry['label_values'], label_values):
+		x0 = entry['prob']
+	if x0 is not None:
+		X0 = np.ascontiguousarray(np.reshape(x0, (nlabels, -1))[:, unknown].T, dtype=dtype)
+	X, setup, info = _solve_linear_system(lap_sparse, B, tol, mode=mode, setup=setup, block=block, maxiter=maxiter,
+	                                      X0=X0, progress=progress, workers=workers, executor=executor)
+	if entry is not None and mask is None:
+		if not patched:
+			entry['setup'] = setup
+			entry['seed_layout'] = (mode, seed_layout)
+			entry['base_unknown'] = unknown
+		if incremental:
+			# Full probability field of this run, seeds have probability 1 for their own label
+			prob = np.zeros((nlabels, unknown.size), dtype=dtype)
+			prob[:, unknown] = X
+			seeds = labels.ravel()
+			for lab in range(1, nlabels + 1):
+				prob[lab - 1][seeds == lab] = 1
+			entry['prob'] = prob
+			entry['label_values'] = label_values
+		cache.put(key, entry)
+		print(cache)
+	print("Solver {mode}: {unknowns} unknowns, setup {setup_time:.2f}s, solve {solve_time:.2f}s, "
+	      "iterations {iterations}, residuals {res}".format(res=["{:.1e}".format(r) for r in info['residuals']], **info))
+	if not all(info['converged']):
+		print("Solver did not converge within {} iterations".format(maxiter))
 	# Build the output according to return_full_prob value
 	# Put back labels of isolated seeds
 	labels[inds_isolated_seeds] = isolated_values
 	labels = labels.reshape(labels_shape)
+	if return_full_prob:
+		out = np.zeros((nlabels, unknown.size), dtype=dtype)
+		out[:, unknown] = X
+		out = out.reshape((nlabels,) + labels_shape)
+		for lab in range(1, nlabels + 1):
+			out[lab - 1][labels == lab] = 1
+	else:
+		X = np.argmax(X, axis=0) + 1
+		out = labels.astype(labels_dtype)
+		out[labels == 0] = X
+		# Labels were renumbered to 1..nlabels by _preprocess, map back to the seed values
+		positive = out > 0
+		out[positive] = label_values[out[positive] - 1]
+	if return_info:
+		return out, info
+	return out
+
+
+def _downsample(volume, factors, reduce):
+	# Block reduction (np.mean for data, np.max for seeds) by integer factors per axis, edges padded
+	pad = [(0, -size % f) for size, f in zip(volume.shape, factors)]
+	volume = np.pad(volume, pad, mode='edge' if reduce is np.mean else 'constant')
+	shape = []
+	for size, f in zip(volume.shape, factors):
+		shape += [size // f, f]
+	return reduce(volume.reshape(shape), axis=(1, 3, 5))
+
 
-	X = np.argmax(X, axis=0) + 1
-	out = labels.astype(labels_dtype)
-	out[labels == 0] = X
+def random_walker_pyramid(data, labels, beta=130, band=2, confidence=0.5, **kwargs):
+	"""
+	Coarse-to-fine random walker. Data and seeds are downsampled by 2 (in depth only for stacks of 8 or more
+	slices), solved at the coarse level and the probabilities interpolated back. Voxels whose most probable
+	label leads the second one by at least confidence and which are more than band coarse voxels away from a
+	label boundary are fixed to that label. Only the remaining band is solved at full resolution, warm-started with the
+	interpolated probabilities. Further keyword arguments are passed to random_walker.
+	Falls back to a full resolution solve if the data is too small or the seeds have pruned zones (< 0).
+	"""
+	return_info = kwargs.pop('return_info', False)
+	kwargs.pop('copy', None)
+	data = np.atleast_3d(img_as_float(data))
+	labels_3d = np.atleast_3d(labels)
+	factors = (2, 2, 2 if data.shape[2] >= 8 else 1)
+	label_values = np.unique(labels_3d[labels_3d > 0])
+	if np.any(labels_3d < 0) or min(data.shape[:2]) < 8:
+		return random_walker(data.reshape(labels.shape), labels, beta=beta, copy=True, return_info=return_info, **kwargs)
+	coarse_labels = _downsample(labels_3d, factors, np.max)
+	if not np.array_equal(np.unique(coarse_labels[coarse_labels > 0]), label_values):
+		print("Seeds of a label got lost at the coarse level, solving at full resolution")
+		return random_walker(data.reshape(labels.shape), labels, beta=beta, copy=True, return_info=return_info, **kwargs)
+	coarse_data = _downsample(data, factors, np.mean)
+	kwargs_coarse = dict(kwargs)
+	kwargs_coarse.pop('x0', None)
+	coarse_prob = random_walker(coarse_data, coarse_labels, beta=beta, copy=False, return_full_prob=True, **kwargs_coarse)
+	# Interpolate back to full resolution and crop the padding
+	prob = np.stack([ndi.zoom(p, factors, order=1)[:data.shape[0], :data.shape[1], :data.shape[2]] for p in coarse_prob])
+	prob_labels = np.argmax(prob, axis=0)
+	boundary = ndi.maximum_filter(prob_labels, size=3) != ndi.minimum_filter(prob_labels, size=3)
+	near_boundary = ndi.binary_dilation(boundary, iterations=band * max(factors))
+	top_two = np.sort(prob, axis=0)[-2:] if prob.shape[0] > 1 else np.stack((np.zeros_like(prob[0]), prob[0]))
+	fixed = (top_two[1] - top_two[0] >= confidence) & ~near_boundary & (labels_3d == 0)
+	fine_labels = labels_3d.copy()
+	fine_labels[fixed] = label_values[prob_labels[fixed]]
+	print("Pyramid: {} of {} unknown voxels fixed by the coarse level".format(
+		np.count_nonzero(fixed), np.count_nonzero(labels_3d == 0)))
+	out = random_walker(data, fine_labels, beta=beta, copy=False, x0=prob, return_info=return_info, **kwargs)
+	if return_info:
+		return out[0].reshape(labels.shape), out[1]
+	return out.reshape(labels.shape)
+
+
+def _slab_bytes_per_voxel(itemsize, nlabels):
+	# Rough peak memory of a slab solve per voxel: weights, matrix and AMG hierarchy with its setup
+	# temporaries (measured up to about 10x the matrix for Ruge-Stuben), fixed probabilities, rhs, solution, CG vectors
+	matrix_bytes = 7 * (itemsize + 4) + 8
+	return 3 * itemsize + 10 * matrix_bytes + (3 * nlabels + 6) * itemsize
+
+
+def _stack_std(data, slab_depth, dtype):
+	# Standard deviation of the stack, accumulated slab by slab without a full size float copy
+	total = 0.0
+	total_sq = 0.0
+	size = int(np.prod(data.shape))
+	for start in range(0, data.shape[2], slab_depth):
+		part = img_as_float(data[:, :, start:start + slab_depth]).astype(dtype, copy=False)
+		total += float(np.sum(part, dtype=np.float64))
+		total_sq += float(np.sum(np.square(part, dtype=np.float64)))
+	mean = total / size
+	return float(np.sqrt(max(total_sq / size - mean ** 2, 0.0)))
+
+
+def random_walker_slabs(data, labels, beta=130, slab_depth=None, overlap=4, tol=1.e-3, mode='cg_amg', block=False,
+                        maxiter=30, memory_budget=2 * 2 ** 30, dtype=np.float64, sweeps=1, return_info=False,
+                        progress=None, workers=1, executor='thread'):
+	"""
+	Slab-wise random walker for stacks whose linear system does not fit into memory at once. The stack is cut
+	into slabs of slab_depth slices (from memory_budget if None) that overlap by overlap slices. The slab with
+	most seeds is solved first, then the sweep goes on slab by slab towards both ends of the stack. The slice
+	a slab shares with the previously solved one is fixed to the probabilities computed there (Dirichlet
+	condition), so seeds act along the whole stack. The label volume is stitched in the middle of each
+	overlap. Peak memory is bounded by the slab size, not by the stack depth.
+	One sweep only carries seed information away from the first slab. Each further sweep (alternating up and
+	down, both shared slices fixed) brings the result closer to the one of a single solve (Schwarz iteration).
+	Stacks that fit into one slab and seeds with pruned zones (< 0) are passed to random_walker.
+	data can also be a 3D object with shape and ndim that returns the float slices of data[:, :, start:stop] on
+	demand (e.g. read from disk), the stack is then never held in memory as a whole.
+	return_info: additionally return a list with the solver diagnostics of each slab solve
+	progress, workers, executor: see random_walker
+	"""
+	if data.shape != labels.shape:
+		raise ValueError('Incompatible data and labels shapes.')
+	if overlap < 2:
+		raise ValueError('Slabs must overlap by at least 2 slices.')
+	dtype = np.dtype(dtype)
+	data_3d = np.atleast_3d(data) if isinstance(data, np.ndarray) else data
+	labels_3d = np.atleast_3d(labels)
+	height, width, depth = labels_3d.shape
+	label_values = np.unique(labels_3d[labels_3d > 0])
+	nlabels = label_values.size
+	if slab_depth is None:
+		slab_depth = int(memory_budget // (_slab_bytes_per_voxel(dtype.itemsize, nlabels) * height * width))
+	slab_depth = max(slab_depth, overlap + 2)
+	if depth <= slab_depth or np.any(labels_3d < 0) or nlabels == 0:
+		return random_walker(data_3d[:, :, :].reshape(labels.shape), labels, beta=beta, tol=tol, copy=True, mode=mode,
+		                     block=block, maxiter=maxiter, memory_budget=memory_budget, dtype=dtype,
+		                     return_info=return_info, progress=progress, workers=workers, executor=executor)
+	# Slab k covers [starts[k], stops[k]) and its result is kept in [keep[k], keep[k + 1])
+	starts = list(range(0, depth - overlap, slab_depth - overlap))
+	stops = [min(start + slab_depth, depth) for start in starts]
+	keep = [0] + [start + overlap // 2 for start in starts[1:]] + [depth]
+	seed_counts = [np.count_nonzero(labels_3d[:, :, start:stop]) for start, stop in zip(starts, stops)]
+	anchor = int(np.argmax(seed_counts))
+	# (slab, neighbours whose shared slice is fixed) in solve order
+	order = [(anchor, [])] + [(k, [k - 1]) for k in range(anchor + 1, len(starts))] + \
+	        [(k, [k + 1]) for k in range(anchor - 1, -1, -1)]
+	for sweep in range(1, sweeps):
+		slabs = range(len(starts)) if sweep % 2 else range(len(starts) - 1, -1, -1)
+		order += [(k, [n for n in (k - 1, k + 1) if 0 <= n < len(starts)]) for k in slabs]
+	std = _stack_std(data_3d, slab_depth, dtype)
+	out = np.empty(labels_3d.shape, dtype=labels.dtype)
+	infos = []
+	boundaries = dict()  # Probabilities (nlabels, height, width) of a solved slab at the shared slice
+	for step, (k, neighbours) in enumerate(order):
+		start, stop = starts[k], stops[k]
+		_report(progress, "Slab {} (slices {}-{})".format(k + 1, start, stop - 1), step, len(order))
+		slab_labels = np.zeros((height, width, stop - start), dtype=np.int32)
+		seeds = labels_3d[:, :, start:stop]
+		slab_labels[seeds > 0] = np.searchsorted(label_values, seeds[seeds > 0]) + 1
+		prob = np.zeros((nlabels,) + slab_labels.shape, dtype=dtype)
+		for lab in range(1, nlabels + 1):
+			prob[lab - 1][slab_labels == lab] = 1
+		for n in neighbours:
+			# Shared slice: first slice with the slab below, last slice with the slab above
+			plane = 0 if n < k else -1
+			fixed = slab_labels[:, :, plane]
+			fixed[fixed == 0] = 1  # Placeholder, the boundary probabilities decide
+			prob[:, :, :, plane] = boundaries[(n, k)]
+		slab_data = img_as_float(data_3d[:, :, start:stop]).astype(dtype, copy=False)[..., np.newaxis]
+		weights = _compute_weights_3d(slab_data, np.ones(3), beta=beta, eps=1.e-8, std=std)
+		del slab_data
+		slab_mode = mode if mode != 'auto' else _select_mode(int(np.count_nonzero(slab_labels == 0)),
+		                                                     stop - start, dtype.itemsize, memory_budget)
+		prob = prob.reshape(nlabels, -1)
+		if slab_mode == 'matrix_free':
+			lap_sparse = _StencilLaplacian(weights, slab_labels)
+			B = lap_sparse.rhs(slab_labels, nlabels, prob)
+		else:
+			lap_sparse, B = _build_linear_system(weights, slab_labels, nlabels, prob)
+		del weights
+		X, _, info = _solve_linear_system(lap_sparse, B, tol, mode=slab_mode, block=block, maxiter=maxiter,
+		                                  progress=progress, workers=workers, executor=executor)
+		info['slab'] = (start, stop)
+		infos.append(info)
+		del lap_sparse, B
+		prob[:, slab_labels.ravel() == 0] = X
+		del X
+		prob = prob.reshape((nlabels,) + slab_labels.shape)
+		if k + 1 < len(starts):
+			boundaries[(k, k + 1)] = prob[:, :, :, starts[k + 1] - start].copy()
+		if k > 0:
+			boundaries[(k, k - 1)] = prob[:, :, :, stops[k - 1] - 1 - start].copy()
+		out[:, :, keep[k]:keep[k + 1]] = label_values[np.argmax(prob[:, :, :, keep[k] - start:keep[k + 1] - start], axis=0)]
+		print("Slab {} of {} (slices {}-{}): {unknowns} unknowns, setup {setup_time:.2f}s, solve {solve_time:.2f}s, "
+		      "iterations {iterations}".format(k + 1, len(starts), start, stop - 1, **info))
+	out = out.reshape(labels.shape)
+	if return_info:
+		return out, infos
 	return out
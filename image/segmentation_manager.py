@@ -3,29 +3,260 @@ from data.dicom_series import DicomSeries
 import image.randomwalker_self as randomwalker_self
 import numpy as np
 import data.tools as imp
+from data.tools import Timer
 from data.data_manager import Datamanager
+from data.image_label import ImageLabel
 from typing import Tuple
+import os
 
+# Keeps Laplacian and AMG hierarchy of the last runs, so re-running with edited seeds or beta skips setup work.
+# Bounded by bytes, cleared when another series is loaded (clear_solver_cache)
+solver_cache = randomwalker_self.SolverCache(budget=512 * 2 ** 20)
+ROI_ALIGN = 16  # ROI borders snap to multiples of this many pixels
 
-def __get_data3D(series: DicomSeries, seg_range: tuple, window: tuple, data: Datamanager) -> Tuple[np.ndarray, np.ndarray]:
-	volume, label = data.getPixelLabel3D(series=series, im_range=seg_range)  # get both matrices of data and label
-	data = imp.arr_hu_to_arr(volume, wc=window[0], ww=window[1])             # HU transform of data
-	data_normalized = (data - np.min(data)) / np.ptp(data)
-	return data_normalized, label
 
+def clear_solver_cache():
+	# Cached weights and solver setups only fit the series they were built for
+	solver_cache.clear()
 
-def randomwalk_range(series: DicomSeries, seg_range: tuple, window: tuple, beta_val: float, data: Datamanager) -> np.ndarray:
-	vol_data, vol_label = __get_data3D(series=series, seg_range=seg_range, window=window, data=data)
+
+def __warm_start(label: np.ndarray, dtype, memory_budget: int = None) -> bool:
+	# Keep the probability field of a run for warm starts only if the solver cache can hold it next to the edge
+	# weights (and it fits memory_budget), else it would be evicted right after being built
+	prob_bytes = np.unique(label[label > 0]).size * label.size * np.dtype(dtype).itemsize
+	weight_bytes = 3 * label.size * np.dtype(dtype).itemsize
+	return prob_bytes + weight_bytes <= solver_cache.budget and (memory_budget is None or prob_bytes <= memory_budget)
+
+
+class SegmentationCancelled(Exception):
+	# Raised by a progress callback to stop a running segmentation (see GUI.segmentation_worker)
+	pass
+
+
+def __normalize(data: np.ndarray, bounds: tuple = None) -> np.ndarray:
+	# Scale to 0..1 in place, by min/max of data or the given (min, max), e.g. of the uncropped images.
+	# A constant image stays 0 instead of becoming NaN
+	low, high = (np.min(data), np.max(data)) if bounds is None else bounds
+	data -= low
+	if high > low:
+		data /= high - low
+	return data
+
+
+def __window_bounds(pixels: np.ndarray, window: tuple, dtype) -> tuple:
+	# (min, max) of the windowed pixels, without windowing all of them: the window is monotone
+	return tuple(imp.arr_hu_to_arr(np.array([pixels.min(), pixels.max()]), wc=window[0], ww=window[1], dtype=dtype))
+
+
+def __roi_box(label: np.ndarray, roi, pad: int) -> Tuple[slice, slice]:
+	# (rows, cols) of the ROI. roi='auto': bounding box of the foreground seeds (all but BG) grown by pad pixels,
+	# else a user box (x0, y0, x1, y1), taken as is (clipped to the image). Borders of the auto box are rounded
+	# outward to multiples of ROI_ALIGN, so small seed edits keep the box (and the solver cache entry).
+	# None if there is nothing to crop
+	height, width = label.shape[:2]
+	if roi == 'auto':
+		fg = label > ImageLabel.LABEL_IDS['BG']
+		rows = np.flatnonzero(np.any(fg, axis=tuple(range(1, fg.ndim))))
+		cols = np.flatnonzero(np.any(fg, axis=(0,) + tuple(range(2, fg.ndim))))
+		if rows.size == 0:
+			return None
+		x0, y0, x1, y1 = cols[0] - pad, rows[0] - pad, cols[-1] + 1 + pad, rows[-1] + 1 + pad
+		y0, x0 = y0 // ROI_ALIGN * ROI_ALIGN, x0 // ROI_ALIGN * ROI_ALIGN
+		y1, x1 = -(-y1 // ROI_ALIGN) * ROI_ALIGN, -(-x1 // ROI_ALIGN) * ROI_ALIGN
+	else:
+		x0, y0, x1, y1 = (int(v) for v in roi)
+	y0, x0, y1, x1 = max(0, y0), max(0, x0), min(height, y1), min(width, x1)
+	if y0 >= y1 or x0 >= x1:
+		raise ValueError("Empty region of interest {}".format(roi))
+	if (y0, x0, y1, x1) == (0, 0, height, width):
+		return None
+	return slice(y0, y1), slice(x0, x1)
+
+
+def __crop_label(label: np.ndarray, box: Tuple[slice, slice]) -> np.ndarray:
+	# Copy of the labels inside box, unseeded pixels on the box border (except on image borders) become BG
+	crop = label[box].copy()
+	border = np.zeros(crop.shape[:2], dtype=bool)
+	if box[0].start > 0:
+		border[0, :] = True
+	if box[0].stop < label.shape[0]:
+		border[-1, :] = True
+	if box[1].start > 0:
+		border[:, 0] = True
+	if box[1].stop < label.shape[1]:
+		border[:, -1] = True
+	border = border.reshape(border.shape + (1,) * (crop.ndim - 2))
+	crop[border & (crop == ImageLabel.LABEL_IDS['NONE'])] = ImageLabel.LABEL_IDS['BG']
+	return crop
+
+
+def __paste_roi(seg: np.ndarray, box: Tuple[slice, slice], shape: tuple) -> np.ndarray:
+	# Full size result, everything outside the ROI is background
+	if box is None:
+		return seg
+	out = np.full(shape, ImageLabel.LABEL_IDS['BG'], dtype=seg.dtype)
+	out[box] = seg
+	return out
+
+
+def __get_data3D(series: DicomSeries, seg_range: tuple, window: tuple, data: Datamanager,
+                 dtype=np.float64, roi=None, roi_pad: int = 16) -> Tuple[np.ndarray, np.ndarray, tuple]:
+	# Returns data and label of the range, cropped to the ROI if roi is set, and the ROI box (None: full size)
+	volume, label = data.getPixelLabel3D(series=series, im_range=seg_range, copy=False)  # get both matrices of data and label
+	box = None if roi is None else __roi_box(label, roi, roi_pad)
+	bounds = __window_bounds(volume, window, dtype)  # Scale of the whole range, a crop is normalized the same way
+	if box is not None:
+		volume = volume[box]
+		label = __crop_label(label, box)
+	data = imp.arr_hu_to_arr(volume, wc=window[0], ww=window[1], dtype=dtype)  # HU transform of data
+	return __normalize(data, bounds), label, box
+
+
+def __get_label3D(series: DicomSeries, seg_range: tuple, roi=None, roi_pad: int = 16) -> Tuple[np.ndarray, tuple]:
+	# Label volume of the range, cropped to the ROI if roi is set, and the ROI box. No pixels are decoded
+	label = np.stack([series.images[i - 1].label.label_map for i in range(seg_range[0], seg_range[1] + 1)], axis=2)
+	box = None if roi is None else __roi_box(label, roi, roi_pad)
+	if box is not None:
+		label = __crop_label(label, box)
+	return label, box
+
+
+class _SlabData:
+	# Windowed and normalized pixels of a range for random_walker_slabs, assembled slab by slab from the series
+	# on data[:, :, start:stop]. Normalized with min/max of the whole range, found in a first pass over the raw
+	# pixels (the window is monotone), so each slab is scaled like the full volume. box: ROI (rows, cols) or None
+
+	def __init__(self, series: DicomSeries, seg_range: tuple, window: tuple, dtype, box, shape: tuple):
+		self.series = series
+		self.numbers = range(seg_range[0], seg_range[1] + 1)
+		self.window = window
+		self.dtype = np.dtype(dtype)
+		self.box = box if box is not None else (slice(None), slice(None))
+		self.shape = shape
+		self.ndim = len(shape)
+		low, high = np.inf, -np.inf
+		for i in self.numbers:
+			pixels = series.getImage(i).pixels
+			low, high = min(low, pixels.min()), max(high, pixels.max())
+		self.low, self.high = imp.arr_hu_to_arr(np.array([low, high]), wc=window[0], ww=window[1], dtype=dtype)
+
+	def __getitem__(self, index) -> np.ndarray:
+		rows, cols, slices = index
+		part = np.stack([self.series.getImage(i).pixels[self.box] for i in self.numbers[slices]], axis=2)
+		part = imp.arr_hu_to_arr(part, wc=self.window[0], ww=self.window[1], dtype=self.dtype)
+		part -= self.low
+		if self.high > self.low:
+			part /= self.high - self.low
+		return part[rows, cols]
+
+
+def randomwalk_range(series: DicomSeries, seg_range: tuple, window: tuple, beta_val: float, data: Datamanager,
+                     mode: str = 'cg_amg', dtype=np.float64, pyramid: bool = False, roi=None,
+                     roi_pad: int = 16, slabs: bool = False, memory_budget: int = 2 * 2 ** 30,
+                     workers: int = 1, executor: str = 'thread', block: bool = False,
+                     progress=None) -> np.ndarray:
+	# mode: solver backend of random_walker, 'auto' picks one by problem size
+	# dtype: np.float32 runs the whole pipeline in single precision with half the memory
+	# pyramid: coarse-to-fine solve, full resolution only near label boundaries (random_walker_pyramid)
+	# roi: only solve inside a box, 'auto' around the foreground seeds + roi_pad pixels or (x0, y0, x1, y1).
+	# The box border is treated as background, as is everything outside of it in the result
+	# slabs: solve in overlapping slabs of slices that fit into memory_budget (bytes), for stacks beyond RAM
+	# workers, executor: solve the labels in parallel, 'thread' or 'process' (see random_walker)
+	# block: solve all labels together with block CG (CG based modes, not combined with workers)
+	# progress: callback progress(stage, step, total) per stage, raising SegmentationCancelled in it stops the run
+	if slabs:
+		series.unpin()  # Slabs are read one after another, pinning would keep the whole range decoded
+	else:
+		series.pin_range(seg_range)  # Lazy series: keep the active range decoded for result browsing
+	if progress is not None:
+		progress("Windowing", 0, 0)
+	if slabs:
+		vol_label, box = __get_label3D(series=series, seg_range=seg_range, roi=roi, roi_pad=roi_pad)
+		vol_data = _SlabData(series, seg_range, window, dtype, box, vol_label.shape)
+	else:
+		vol_data, vol_label, box = __get_data3D(series=series, seg_range=seg_range, window=window, data=data,
+		                                        dtype=dtype, roi=roi, roi_pad=roi_pad)
+	full_shape = series.getImage(seg_range[0]).label.label_map.shape + (vol_label.shape[2],)
 	print("Start segmentation with wc={} ww={} beta={}".format(window[0], window[1], beta_val))
-	seg = randomwalker_self.random_walker(vol_data, vol_label, copy=False, beta=beta_val)
+	if slabs:
+		seg = randomwalker_self.random_walker_slabs(vol_data, vol_label, beta=beta_val, mode=mode, dtype=dtype,
+		                                            memory_budget=memory_budget, workers=workers, executor=executor,
+		                                            block=block, progress=progress)
+	elif pyramid:
+		seg = randomwalker_self.random_walker_pyramid(vol_data, vol_label, beta=beta_val, cache=solver_cache,
+		                                              cache_key=(series.path, seg_range), mode=mode, dtype=dtype,
+		                                              workers=workers, executor=executor, block=block,
+		                                              progress=progress)
+	else:
+		seg = randomwalker_self.random_walker(vol_data, vol_label, copy=True, beta=beta_val,  # labels may be series views
+		                                      cache=solver_cache, cache_key=(series.path, seg_range), mode=mode,
+		                                      dtype=dtype, workers=workers, executor=executor, block=block,
+		                                      # Re-runs after seed edits warm start, if the cache can keep the field
+		                                      incremental=__warm_start(vol_label, dtype, memory_budget),
+		                                      progress=progress)
+	seg = __paste_roi(np.atleast_3d(seg), box, full_shape)
 	#data.export_np(seg, "seg-range") if data is not None else None
-	return np.atleast_3d(seg)  # export matrix anyways as 3D to not confuse later on
+	return seg  # export matrix anyways as 3D to not confuse later on
 
 
-def randomwalk_single(image: DicomImage, window: tuple, beta_val: float, data: Datamanager = None) -> np.ndarray:
-	im_data = imp.arr_hu_to_arr(image.pixels, wc=window[0], ww=window[1])
-	data_normalized = (im_data - np.min(im_data)) / np.ptp(im_data)
+def randomwalk_single(image: DicomImage, window: tuple, beta_val: float, data: Datamanager = None,
+                      mode: str = 'cg_amg', dtype=np.float64, roi=None, roi_pad: int = 16,
+                      workers: int = 1, executor: str = 'thread', block: bool = False,
+                      progress=None) -> np.ndarray:
+	# roi, roi_pad, workers, executor, block, progress: see randomwalk_range
+	if progress is not None:
+		progress("Windowing", 0, 0)
+	pixels = image.pixels
+	label = image.label.label_map
+	box = None if roi is None else __roi_box(label, roi, roi_pad)
+	bounds = __window_bounds(pixels, window, dtype)
+	if box is not None:
+		pixels = pixels[box]
+		label = __crop_label(label, box)
+	im_data = imp.arr_hu_to_arr(pixels, wc=window[0], ww=window[1], dtype=dtype)
+	data_normalized = __normalize(im_data, bounds)
 	print("Start segmentation with wc={} ww={} beta={}".format(window[0], window[1], beta_val))
-	seg = randomwalker_self.random_walker(data_normalized, image.label.label_map, copy=False, beta=beta_val)
+	seg = randomwalker_self.random_walker(data_normalized, label, copy=True, beta=beta_val,
+	                                      cache=solver_cache, cache_key=image.path, mode=mode, dtype=dtype,
+	                                      workers=workers, executor=executor, block=block,
+	                                      incremental=__warm_start(label, dtype), progress=progress)
+	seg = __paste_roi(seg, box, image.label.label_map.shape)
 	data.export_np(seg, "seg-single") if data is not None else None
 	return seg
+
+
+def benchmark_pyramid(series: DicomSeries, seg_range: tuple, window: tuple, beta_val: float, data: Datamanager,
+                      mode: str = 'cg_amg') -> dict:
+	# Compare the pyramid mode of randomwalk_range against the full resolution solve on the same seeds
+	results = dict()
+	segmentations = dict()
+	for pyramid in (False, True):
+		solver_cache.clear()  # Both runs start cold
+		t = Timer()
+		t.start()
+		segmentations[pyramid] = randomwalk_range(series, seg_range, window, beta_val, data, mode=mode, pyramid=pyramid)
+		results["pyramid" if pyramid else "full"] = t.stop()
+	results["agreement"] = float(np.mean(segmentations[False] == segmentations[True]))
+	results["speedup"] = results["full"] / results["pyramid"]
+	print("Pyramid benchmark {}: {}".format(seg_range, results))
+	return results
+
+
+def benchmark_workers(series: DicomSeries, seg_range: tuple, window: tuple, beta_val: float, data: Datamanager,
+                      mode: str = 'cg_amg', executor: str = 'process', max_workers: int = None) -> dict:
+	# Scaling of the parallel label solves: solve time with 1..max_workers workers (default: CPU count, at least 2)
+	# on the same system. The solver setup is built once and reused from a private cache, so only solves are timed
+	vol_data, vol_label, _ = __get_data3D(series=series, seg_range=seg_range, window=window, data=data)
+	cache = randomwalker_self.SolverCache()
+	results = {'solve_time': dict(), 'speedup': dict(), 'identical': True}
+	reference = None
+	for workers in range(1, (max_workers or max(2, os.cpu_count() or 1)) + 1):
+		seg, info = randomwalker_self.random_walker(vol_data, vol_label, copy=True, beta=beta_val, cache=cache,
+		                                            mode=mode, workers=workers, executor=executor, return_info=True)
+		results['solve_time'][workers] = info['solve_time']
+		results['speedup'][workers] = results['solve_time'][1] / info['solve_time']
+		if reference is None:
+			reference = seg
+		results['identical'] = results['identical'] and bool(np.array_equal(reference, seg))
+	print("Worker benchmark {} ({}, {}): {}".format(seg_range, mode, executor, results))
+	return results
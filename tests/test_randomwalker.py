@@ -0,0 +1,187 @@
+import threading
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.sparse.linalg import aslinearoperator
+import image.randomwalker_self as randomwalker_self
+import image.segmentation_manager as segment
+from data.data_manager import Datamanager
+from data.image_label import ImageLabel
+
+
+def stencil_problem(seed=0):
+	rng = np.random.default_rng(seed)
+	data = rng.random((20, 30, 8))
+	labels = np.zeros(data.shape, dtype=np.int32)
+	labels[0] = 1
+	labels[-1] = 2
+	return data, labels
+
+
+def coo_linear_system(weights, labels, nlabels):
+	# Former construction: full Laplacian from an edge list (COO + setdiag), then sliced into A and B
+	n_nodes = labels.size
+	nodes = np.arange(n_nodes).reshape(labels.shape)
+	rows, cols, values = [], [], []
+	for ax in range(3):
+		inner = tuple(slice(0, -1) if a == ax else slice(None) for a in range(3))
+		outer = tuple(slice(1, None) if a == ax else slice(None) for a in range(3))
+		rows += [nodes[inner].ravel(), nodes[outer].ravel()]
+		cols += [nodes[outer].ravel(), nodes[inner].ravel()]
+		values += [-weights[ax][inner].ravel()] * 2
+	lap = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+	                        shape=(n_nodes, n_nodes))
+	lap.setdiag(-np.ravel(lap.sum(axis=0)))
+	lap = lap.tocsr()
+	flat = labels.ravel()
+	unknown = np.flatnonzero(flat == 0)
+	seeds = np.flatnonzero(flat > 0)
+	rows = lap[unknown, :]
+	onehot = np.stack([flat[seeds] == lab for lab in range(1, nlabels + 1)], axis=1).astype(float)
+	return rows[:, unknown], -(rows[:, seeds] @ onehot)
+
+
+def test_build_linear_system_matches_coo():
+	data, labels = stencil_problem()
+	labels[5:8, 10:14, 3:5] = 3
+	weights = randomwalker_self._compute_weights_3d(data[..., None], (1, 1, 1), 130, 1e-6)
+	A, B = randomwalker_self._build_linear_system(weights, labels, 3)
+	A_ref, B_ref = coo_linear_system(weights, labels, 3)
+	assert A.has_sorted_indices and A.nnz == A_ref.nnz
+	np.testing.assert_allclose(A.toarray(), A_ref.toarray(), rtol=1e-12)
+	np.testing.assert_allclose(B, B_ref, rtol=1e-12)
+
+
+def test_stencil_matvec_matches_matrix():
+	data, labels = stencil_problem()
+	labels[5:8, 10:14, 3:5] = 3
+	weights = randomwalker_self._compute_weights_3d(data[..., None], (1, 1, 1), 130, 1e-6)
+	A, B = randomwalker_self._build_linear_system(weights, labels, 3)
+	op = randomwalker_self._StencilLaplacian(weights, labels)
+	x = np.random.default_rng(2).random(A.shape[0])
+	np.testing.assert_allclose(op.matvec(x), A @ x, rtol=1e-12, atol=1e-12)
+	np.testing.assert_allclose(op.diagonal(), A.diagonal(), rtol=1e-12)
+	np.testing.assert_allclose(op.rhs(labels, 3), B, rtol=1e-12, atol=1e-12)
+
+
+def test_stencil_matvec_concurrent():
+	# Label columns are solved by threads, all of them using the same operator
+	data, labels = stencil_problem()
+	weights = randomwalker_self._compute_weights_3d(data[..., None], (1, 1, 1), 130, 1e-6)
+	op = randomwalker_self._StencilLaplacian(weights, labels)
+	rng = np.random.default_rng(1)
+	xs = [rng.random(op.shape[0]) for _ in range(40)]
+	expected = [op.matvec(x) for x in xs]
+	wrong = []
+
+	def run(first):
+		for i in range(first, len(xs), 4):
+			for _ in range(5):
+				if not np.allclose(op.matvec(xs[i]), expected[i]):
+					wrong.append(i)
+
+	threads = [threading.Thread(target=run, args=(k,)) for k in range(4)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	assert wrong == []
+
+
+def test_matrix_free_thread_workers():
+	data, labels = stencil_problem()
+	serial = randomwalker_self.random_walker(data, labels, mode='matrix_free', workers=1, return_full_prob=True)
+	threaded = randomwalker_self.random_walker(data, labels, mode='matrix_free', workers=4, executor='thread',
+	                                           return_full_prob=True)
+	np.testing.assert_allclose(threaded, serial, atol=1e-12)
+
+
+def test_solver_cache_budget():
+	data, labels = stencil_problem()
+	cache = randomwalker_self.SolverCache()
+	randomwalker_self.random_walker(data, labels, mode='cg_amg', cache=cache, cache_key=1)
+	entry_bytes = cache.nbytes
+	assert entry_bytes > 0
+	# Room for one entry: the older one is evicted
+	cache.budget = int(1.5 * entry_bytes)
+	randomwalker_self.random_walker(data, labels, mode='cg_amg', cache=cache, cache_key=2)
+	assert len(cache.entries) == 1 and cache.nbytes <= cache.budget
+	assert cache.stats['evictions'] == 1
+	# An entry larger than the budget is not kept
+	cache.budget = entry_bytes // 2
+	randomwalker_self.random_walker(data, labels, mode='cg_amg', cache=cache, cache_key=3)
+	assert len(cache.entries) == 0 and cache.nbytes == 0
+
+
+def test_solver_cache_drops_warm_start_first():
+	data, labels = stencil_problem()
+	cache = randomwalker_self.SolverCache()
+	randomwalker_self.random_walker(data, labels, mode='cg_amg', cache=cache, dtype=np.float32, incremental=True)
+	entry = next(iter(cache.entries.values()))
+	assert entry['prob'].dtype == np.float32
+	prob_bytes = entry['prob'].nbytes
+	assert cache.nbytes > prob_bytes
+	cache.budget = cache.nbytes - prob_bytes // 2
+	randomwalker_self.random_walker(data, labels, mode='cg_amg', cache=cache, dtype=np.float32, incremental=True)
+	assert len(cache.entries) == 1 and entry['prob'] is None and entry['setup'] is not None
+	assert cache.nbytes <= cache.budget
+	cache.clear()
+	assert cache.nbytes == 0
+
+
+class SlabSource:
+	# Stack that is only readable slab by slab, as segmentation_manager passes lazy series
+	def __init__(self, data):
+		self.data = data
+		self.shape = data.shape
+		self.ndim = data.ndim
+		self.reads = []
+
+	def __getitem__(self, index):
+		self.reads.append(index[2])
+		return self.data[index].copy()
+
+
+def test_slabs_from_source():
+	data, labels = stencil_problem()
+	source = SlabSource(data)
+	expected = randomwalker_self.random_walker_slabs(data, labels, slab_depth=4, overlap=2)
+	assert np.array_equal(randomwalker_self.random_walker_slabs(source, labels, slab_depth=4, overlap=2), expected)
+	assert all(s.stop - s.start <= 4 for s in source.reads)
+
+
+# Exact solve: only precision differs. cg_amg stops at tol 1e-3, the two runs stop at different iterates
+@pytest.mark.parametrize('path, seg_range, mode, threshold', [('series/lowres', (1, 1), 'direct', 0.999),
+                                                              ('series/head', (20, 21), 'cg_amg', 0.995)])
+def test_float32_labels_match_float64(path, seg_range, mode, threshold):
+	data = Datamanager()
+	data.load_series(path, workers=1)
+	series = data.current_series
+	for i in range(seg_range[0], seg_range[1] + 1):
+		label = series.getImage(i).label.label_map
+		height, width = label.shape
+		label[:height // 16] = ImageLabel.LABEL_IDS['BG']
+		label[height // 3:height // 3 + height // 16, width // 3:width // 3 + width // 16] = ImageLabel.LABEL_IDS['CL1']
+		label[-height // 4:-height // 4 + height // 16, width // 2:width // 2 + width // 16] = ImageLabel.LABEL_IDS['CL2']
+	window = (40, 400)
+	seg = {dtype: segment.randomwalk_range(series, seg_range, window, 130, data, mode=mode, dtype=dtype)
+	       for dtype in (np.float64, np.float32)}
+	segment.clear_solver_cache()
+	agreement = np.mean(seg[np.float32] == seg[np.float64])
+	assert agreement > threshold, agreement
+
+
+def test_block_cg_converged_on_last_iteration():
+	data, labels = stencil_problem()
+	weights = randomwalker_self._compute_weights_3d(data[..., None], (1, 1, 1), 130, 1e-6)
+	A, B = randomwalker_self._build_linear_system(weights, labels, 2)
+	M = aslinearoperator(sparse.diags(1 / A.diagonal()))  # Jacobi
+	_, iterations, converged = randomwalker_self._block_cg(A, B, M, tol=1e-3, maxiter=100)
+	assert all(converged)
+	# Exactly as many iterations as needed: the tolerance is met on the last one
+	_, last, converged = randomwalker_self._block_cg(A, B, M, tol=1e-3, maxiter=max(iterations))
+	assert last == iterations and all(converged)
+	_, _, info = randomwalker_self._solve_linear_system(A, B, 1e-3, mode='cg_j', block=True, maxiter=max(iterations))
+	assert all(info['converged'])
+	_, _, converged = randomwalker_self._block_cg(A, B, M, tol=1e-3, maxiter=max(iterations) - 1)
+	assert not all(converged)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import image.segmentation_manager as segment
+from data.data_manager import Datamanager
+
+get_data3D = getattr(segment, '__get_data3D')
+
+
+@pytest.fixture(scope='module')
+def head():
+	data = Datamanager()
+	data.load_series('series/head', workers=1)
+	for image in data.current_series.images[:4]:
+		image.label.label_map[200:230, 150:170] = 2
+	return data
+
+
+def test_roi_normalized_like_full_range(head):
+	seg_range, window = (1, 4), (500, 4000)
+	full, _, _ = get_data3D(head.current_series, seg_range, window, head)
+	crop, _, box = get_data3D(head.current_series, seg_range, window, head, roi='auto')
+	assert box is not None and crop.shape[:2] != full.shape[:2]
+	np.testing.assert_allclose(crop, full[box], atol=1e-12)
+
+
+def test_user_box_taken_as_is(head):
+	_, label, box = get_data3D(head.current_series, (1, 2), (40, 400), head, roi=(101, 53, 219, 300))
+	assert box == (slice(53, 300), slice(101, 219))
+	assert label.shape[:2] == (247, 118)
+
+
+@pytest.mark.parametrize('budget, kept', [(512 * 2 ** 20, True), (64 * 64 * 8 * 4, False)])
+def test_warm_start_only_if_cached(budget, kept):
+	data = Datamanager()
+	data.load_series('series/lowres', workers=1)
+	label = data.current_series.getImage(1).label.label_map
+	label[:4] = 1
+	label[30:34, 30:34] = 2
+	old_budget = segment.solver_cache.budget
+	segment.solver_cache.budget = budget
+	try:
+		segment.randomwalk_range(data.current_series, (1, 1), (40, 400), 130, data)
+		entries = list(segment.solver_cache.entries.values())
+		assert (len(entries) == 1 and entries[0]['prob'] is not None) == kept
+	finally:
+		segment.solver_cache.budget = old_budget
+		segment.clear_solver_cache()
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import data.tools as tools
+
+# (wc, ww) of the GUI default, common CT windows and the degenerate widths
+WINDOWS = [(100, 200), (40, 400), (500, 1000), (-600, 1500), (0, 1), (0, 2), (37, 1), (37, 2)]
+
+
+def raw_values(wc, ww):
+	# A CT range plus the values around both window bounds
+	edges = [wc - 0.5 - (ww - 1) / 2, wc - 0.5 + (ww - 1) / 2]
+	near = np.concatenate([np.arange(np.floor(e) - 3, np.ceil(e) + 4) for e in edges])
+	return np.concatenate([np.arange(-1100, 3001, 7), near]).astype(np.int16)
+
+
+@pytest.mark.parametrize("wc, ww", WINDOWS)
+def test_matches_window_hu(wc, ww):
+	raw = raw_values(wc, ww)
+	expected = np.array([tools.window_hu(v, wc, ww) for v in raw.tolist()], dtype=np.float64)
+	result = tools.arr_hu_to_arr(raw, ww=ww, wc=wc)
+	assert result.dtype == np.float64
+	np.testing.assert_allclose(result, expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("wc, ww", WINDOWS)
+def test_dtypes(wc, ww):
+	raw = raw_values(wc, ww)
+	expected = np.array([tools.window_hu(v, wc, ww) for v in raw.tolist()], dtype=np.float64)
+	np.testing.assert_allclose(tools.arr_hu_to_arr(raw, ww=ww, wc=wc, dtype=np.float32), expected, atol=1e-3)
+	result = tools.arr_hu_to_arr(raw, ww=ww, wc=wc, dtype=np.uint8)
+	assert result.dtype == np.uint8
+	assert np.abs(result - expected).max() < 1  # Truncated like the former int result
+
+
+def test_out_buffer_reused():
+	raw = raw_values(100, 200).reshape(-1, 1)
+	out = np.empty(raw.shape, dtype=np.uint8)
+	result = tools.arr_hu_to_arr(raw, ww=200, wc=100, dtype=np.uint8, out=out)
+	assert result is out
+	np.testing.assert_array_equal(result, tools.arr_hu_to_arr(raw, ww=200, wc=100, dtype=np.uint8))